@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+# Benchmark the bot's update handlers offline, against contrib/fakebotapi.py.
+# Each scenario feeds the real handlers synthetic updates, and reports latency,
+# throughput and Bot API calls per update. Run from the repo root like this:
+#       PYTHONPATH=. ./contrib/bench_handlers.py -n 200 --concurrency 8 --latency 0.02
+# Caches (chat admins, next show times, ...) stay warm between scenarios, as
+# they would in the running bot.
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from fakebotapi import add_arguments, bind, FakeBotAPI, from_arguments, start
+from telegram import Update
+
+TOKEN = "123456:fakefakefakefakefakefakefakefake"
+BOT_ID = 123456
+ADMIN_ID = 1000
+GROUP_ID = -1001000000001
+ADMIN_CHAT_ID = -1001000000002
+CHANNEL_ID = -1001000000003
+
+# {base} is the fake server's URL, {state} a scratch directory
+CONFIG = """
+telegram_token = "{token}"
+telegram_base_url = "{base}/bot"
+api_key = "bench"
+default_invite_chat = "group"
+rate_limit_template = "Sorry, try again later."
+log_level = "WARNING"
+state_db = "{state}/state.sqlite3"
+showtime_cache_file = "{state}/showtime_cache.json"
+topic_coalesce_seconds = 0
+np_coalesce_seconds = 0
+config_watch_seconds = 0
+
+# Throttling would measure the rate limits rather than the handlers
+[outbound]
+overall_per_second = 100000
+overall_burst = 100000
+group_per_minute = 6000000
+group_burst = 100000
+private_per_second = 100000
+private_burst = 100000
+
+[chats.group]
+id = {group_id}
+invite = true
+admin_chat = "admins"
+topic_approval_chat = "admins"
+next_show_default = "show"
+
+[chats.admins]
+id = {admin_chat_id}
+
+[chats.channel]
+id = {channel_id}
+
+[shows.show]
+name = "Bench Show"
+domain = "example.invalid"
+nextshow_url = "{base}/nextshow/"
+
+[announce]
+show = [ "channel", "group" ]
+show-np = [ "group" ]
+
+[timezones]
+"America/New_York" = [ "eastern", "edt", "est", "et" ]
+"""
+
+
+def use_config(state: str, port: int) -> None:
+    """Point the bot, when it's imported, at a fake Bot API on this port."""
+    config_file = os.path.join(state, "config.toml")
+    with open(config_file, "w") as f:
+        f.write(
+            CONFIG.format(
+                token=TOKEN,
+                base=f"http://127.0.0.1:{port}",
+                state=state,
+                group_id=GROUP_ID,
+                admin_chat_id=ADMIN_CHAT_ID,
+                channel_id=CHANNEL_ID,
+            )
+        )
+    os.environ["CONFIG"] = config_file
+    os.environ.pop("CONFIG_CACHE", None)
+
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1000000)
+
+
+def percentile(ordered: Sequence[float], p: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if not ordered:
+        return float("nan")
+    rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def user(user_id: int) -> Dict[str, Any]:
+    return {
+        "id": user_id,
+        "is_bot": False,
+        "first_name": f"User {user_id}",
+        "username": f"user{user_id}",
+    }
+
+
+def chat(chat_id: int) -> Dict[str, Any]:
+    if chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+    return {"id": chat_id, "type": "supergroup", "title": "Bench Group"}
+
+
+def message(
+    chat_id: int,
+    user_id: int,
+    text: str,
+    reply_to: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    data = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": chat(chat_id),
+        "from": user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split(" ", 1)[0]
+        data["entities"] = [
+            {"type": "bot_command", "offset": 0, "length": len(command)}
+        ]
+    elif "@admin" in text:
+        data["entities"] = [
+            {"type": "mention", "offset": text.index("@admin"), "length": 6}
+        ]
+    if reply_to is not None:
+        data["reply_to_message"] = reply_to
+    return {"update_id": next(_update_ids), "message": data}
+
+
+def callback_query(user_id: int, data: str) -> Dict[str, Any]:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_message_ids)),
+            "from": user(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": message(ADMIN_CHAT_ID, BOT_ID, "Proposed topic")["message"],
+        },
+    }
+
+
+def chat_join_request(user_id: int) -> Dict[str, Any]:
+    return {
+        "update_id": next(_update_ids),
+        "chat_join_request": {
+            "chat": chat(GROUP_ID),
+            "from": user(user_id),
+            "user_chat_id": user_id,
+            "date": int(time.time()),
+            "invite_link": {
+                "invite_link": f"https://t.me/+bench{user_id}",
+                "creator": {"id": BOT_ID, "is_bot": True, "first_name": "Fake Bot"},
+                "creates_join_request": True,
+                "is_primary": False,
+                "is_revoked": False,
+                "name": f"{user_id} @user{user_id}",
+            },
+        },
+    }
+
+
+class Scenario:
+    """Updates for one handler. setup runs untimed before the timed update."""
+
+    __slots__ = ("name", "update", "setup")
+
+    def __init__(
+        self,
+        name: str,
+        update: Callable[[int], Dict[str, Any]],
+        setup: Optional[Callable[[int], Awaitable[None]]] = None,
+    ):
+        self.name = name
+        self.update = update
+        self.setup = setup
+
+
+async def settle(api: FakeBotAPI, quiet: float = 0.2) -> None:
+    """Wait for background work, eg. topic changes, to stop calling the API."""
+    seen = -1
+    while seen != len(api.calls):
+        seen = len(api.calls)
+        await asyncio.sleep(quiet)
+
+
+async def run_scenario(
+    application, api: FakeBotAPI, scenario: Scenario, n: int, concurrency: int
+) -> Dict[str, Any]:
+    if scenario.setup is not None:
+        for i in range(n):
+            await scenario.setup(i)
+        await settle(api)
+    api.reset()
+    application.bot_data["errors"] = 0
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await application.process_update(
+                Update.de_json(scenario.update(i), application.bot)
+            )
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    elapsed = time.perf_counter() - started
+    await settle(api)
+    latencies.sort()
+    counts = api.counts()
+    return {
+        "scenario": scenario.name,
+        "updates": n,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "updates_per_second": n / elapsed,
+        "calls_per_update": sum(counts.values()) / n,
+        "refused_429": api.refused,
+        "nextshow_fetches": api.nextshow_hits,
+        "errors": application.bot_data["errors"],
+        "methods": {method: count / n for method, count in counts.most_common()},
+    }
+
+
+def scenarios(application) -> List[Scenario]:
+    from furcastbot.proposals import topic_proposals
+
+    async def process(data: Dict[str, Any]) -> None:
+        await application.process_update(Update.de_json(data, application.bot))
+
+    async def propose(i: int) -> None:
+        await process(message(GROUP_ID, 20000 + i, f"/topic Proposal {i}"))
+
+    def accept(i: int) -> Dict[str, Any]:
+        proposal = topic_proposals.find(GROUP_ID, f"Proposal {i}")
+        return callback_query(ADMIN_ID, f"ta:{proposal.id if proposal else 'gone'}")
+
+    async def join_start(i: int) -> None:
+        await process(message(40000 + i, 40000 + i, "/join group"))
+
+    reported = message(GROUP_ID, 30000, "Something awful")["message"]
+    return [
+        Scenario("next", lambda i: message(GROUP_ID, 10000 + i, "/next")),
+        Scenario(
+            "next_timezone",
+            lambda i: message(GROUP_ID, 10000 + i, "/next show eastern"),
+        ),
+        Scenario(
+            "report",
+            lambda i: message(GROUP_ID, 10000 + i, "/report spam", reply_to=reported),
+        ),
+        Scenario(
+            "report_mention",
+            lambda i: message(GROUP_ID, 10000 + i, "@admin help", reply_to=reported),
+        ),
+        Scenario("topic", lambda i: message(GROUP_ID, ADMIN_ID, f"/topic Topic {i}")),
+        Scenario(
+            "topic_proposal",
+            lambda i: message(GROUP_ID, 20000 + i, f"/topic Another {i}"),
+        ),
+        Scenario("button", accept, setup=propose),
+        Scenario("join_start", lambda i: message(30000 + i, 30000 + i, "/join group")),
+        Scenario(
+            "join_real",
+            lambda i: message(40000 + i, 40000 + i, "I agree"),
+            setup=join_start,
+        ),
+        Scenario("chat_join_request", lambda i: chat_join_request(50000 + i)),
+    ]
+
+
+async def bench(args: argparse.Namespace, api: FakeBotAPI, sockets) -> List[dict]:
+    from furcastbot.furcastbot import build_application
+
+    start(api, sockets)
+    application = build_application()
+
+    async def count_error(update: object, context) -> None:
+        context.bot_data["errors"] = context.bot_data.get("errors", 0) + 1
+        logging.debug("Handler error: %s", context.error)
+
+    application.add_error_handler(count_error)
+    results = []
+    async with application:
+        # For the join conversation's timeouts
+        await application.job_queue.start()
+        for scenario in scenarios(application):
+            if args.scenarios and scenario.name not in args.scenarios:
+                continue
+            result = await run_scenario(
+                application, api, scenario, args.updates, args.concurrency
+            )
+            results.append(result)
+            print_result(result)
+        await application.job_queue.stop()
+    return results
+
+
+def print_result(result: Dict[str, Any]) -> None:
+    print(
+        "{scenario:<18} {updates:>5} {p50_ms:>8.2f} {p99_ms:>8.2f} "
+        "{updates_per_second:>9.1f} {calls_per_update:>9.2f} {errors:>6}".format(
+            **result
+        )
+    )
+    methods = ", ".join(
+        f"{method} {per_update:.2f}" for method, per_update in result["methods"].items()
+    )
+    extra = [
+        f"{result[key]} {label}"
+        for key, label in (("nextshow_fetches", "/nextshow/"), ("refused_429", "429s"))
+        if result[key]
+    ]
+    print(f"{'':<18} {', '.join([methods or 'no Bot API calls', *extra])}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark update handlers against a fake Bot API"
+    )
+    parser.add_argument("scenarios", nargs="*", help="Scenarios to run (default: all)")
+    parser.add_argument(
+        "-n", "--updates", type=int, default=100, help="Updates per scenario"
+    )
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=1, help="Updates in flight at once"
+    )
+    parser.add_argument("--json", help="Also write the results to this file")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)  # The fake's 429s
+    api = from_arguments(args, admin_id=ADMIN_ID)
+    sockets, port = bind()
+    with tempfile.TemporaryDirectory() as state:
+        use_config(state, port)
+        print(
+            "{:<18} {:>5} {:>8} {:>8} {:>9} {:>9} {:>6}".format(
+                "scenario", "n", "p50 ms", "p99 ms", "updates/s", "calls/upd", "errors"
+            )
+        )
+        results = asyncio.run(bench(args, api, sockets))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if any(result["errors"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
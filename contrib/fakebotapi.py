@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+
+# Stand-in for api.telegram.org and the show sites' /nextshow/, for benchmarks
+# and trying the bot offline. Records every call, and can add latency and 429s.
+# Run like this, then point the bot at it with
+#   telegram_base_url = "http://127.0.0.1:8081/bot"
+#   nextshow_url = "http://127.0.0.1:8081/nextshow/" (in each [shows.x] table)
+#       ./contrib/fakebotapi.py --latency 0.05 --rate-429 0.01
+# GET /_calls for call counts by method, DELETE /_calls to reset them.
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from collections import Counter
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import itertools
+import json
+import random
+import socket
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram import (
+    AcceptedGiftTypes,
+    Chat,
+    ChatFullInfo,
+    ChatInviteLink,
+    ChatMemberAdministrator,
+    ChatMemberLeft,
+    ChatMemberOwner,
+    Message,
+    User,
+)
+from tornado.httpserver import HTTPServer
+import tornado.netutil
+import tornado.web
+
+# AcceptedGiftTypes fields, which vary between python-telegram-bot versions
+GIFT_TYPES = (
+    "unlimited_gifts",
+    "limited_gifts",
+    "unique_gifts",
+    "premium_subscription",
+    "gifts_from_channels",
+)
+# Methods answered with a bare True
+TRUE_METHODS = frozenset(
+    [
+        "answerCallbackQuery",
+        "approveChatJoinRequest",
+        "close",
+        "declineChatJoinRequest",
+        "deleteMessage",
+        "deleteMessages",
+        "deleteMyCommands",
+        "deleteWebhook",
+        "logOut",
+        "setChatDescription",
+        "setMyCommands",
+        "setWebhook",
+        "unpinAllChatMessages",
+    ]
+)
+# Methods answered with the Message they sent or edited
+MESSAGE_METHODS = frozenset(
+    [
+        "editMessageCaption",
+        "editMessageReplyMarkup",
+        "editMessageText",
+        "forwardMessage",
+        "sendAnimation",
+        "sendDocument",
+        "sendMessage",
+        "sendPhoto",
+        "sendSticker",
+    ]
+)
+
+
+class ApiError(Exception):
+    def __init__(self, code: int, description: str, retry_after: Optional[int] = None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class Call:
+    """One Bot API request as received."""
+
+    __slots__ = ("method", "params", "at")
+
+    def __init__(self, method: str, params: Dict[str, Any], at: float):
+        self.method = method
+        self.params = params
+        self.at = at
+
+
+def _decode(value: str) -> Any:
+    """python-telegram-bot sends non-string parameters JSON encoded."""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _chat_id(value: Any) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1  # @channelusername
+
+
+class FakeBotAPI:
+    """A Bot API server that answers every call with a plausible result.
+
+    Chats with positive IDs are private chats with users, the rest are
+    supergroups. admin_id owns every group, and the bot is an admin in all of
+    them. Everyone else has left every group, so can be invited. Titles, pins
+    and invite links are remembered. rate_429 of calls, other than getMe, are
+    refused with retry_after.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_429: float = 0.0,
+        retry_after: int = 1,
+        admin_id: int = 1000,
+        next_show_in: int = 3600,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.admin_id = admin_id
+        self.next_show_in = next_show_in
+        self.calls: List[Call] = []
+        self.refused = 0
+        self.nextshow_hits = 0
+        self._message_ids = itertools.count(1)
+        self._link_ids = itertools.count(1)
+        self._titles: Dict[int, str] = {}
+        self._pins: Dict[int, int] = {}
+        self._links: Dict[str, ChatInviteLink] = {}
+        self._methods: Dict[str, Callable[[str, Dict[str, Any]], Any]] = {
+            "getMe": self._get_me,
+            "getUpdates": self._get_updates,
+            "getChat": self._get_chat,
+            "getChatAdministrators": self._get_chat_administrators,
+            "getChatMember": self._get_chat_member,
+            "setChatTitle": self._set_chat_title,
+            "pinChatMessage": self._pin_chat_message,
+            "unpinChatMessage": self._unpin_chat_message,
+            "copyMessage": self._copy_message,
+            "createChatInviteLink": self._create_chat_invite_link,
+            "revokeChatInviteLink": self._revoke_chat_invite_link,
+            "exportChatInviteLink": self._export_chat_invite_link,
+        }
+
+    def counts(self) -> Counter:
+        """Calls so far by method."""
+        return Counter(call.method for call in self.calls)
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self.refused = 0
+        self.nextshow_hits = 0
+
+    def application(self) -> tornado.web.Application:
+        return tornado.web.Application(
+            [
+                (r"/bot([^/]+)/(\w+)", _MethodHandler, {"api": self}),
+                (r"/_calls", _CallsHandler, {"api": self}),
+                (r"/(?:.*/)?nextshow/?", _NextShowHandler, {"api": self}),
+            ]
+        )
+
+    async def delay(self) -> None:
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+    async def call(self, token: str, method: str, params: Dict[str, Any]) -> Any:
+        """The result of a Bot API call, or ApiError."""
+        self.calls.append(Call(method, params, time.monotonic()))
+        await self.delay()
+        if method != "getMe" and random.random() < self.rate_429:
+            self.refused += 1
+            raise ApiError(
+                429,
+                f"Too Many Requests: retry after {self.retry_after}",
+                self.retry_after,
+            )
+        if method in TRUE_METHODS:
+            return True
+        if method in MESSAGE_METHODS:
+            return self._message(token, params)
+        handler = self._methods.get(method)
+        if handler is None:
+            raise ApiError(404, "Not Found")
+        result = handler(token, params)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    @staticmethod
+    def _bot(token: str) -> User:
+        return User(
+            int(token.split(":", 1)[0]),
+            first_name="Fake Bot",
+            is_bot=True,
+            username="fake_bot",
+        )
+
+    def _get_me(self, token: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(
+            self._bot(token).to_dict(),
+            can_join_groups=True,
+            can_read_all_group_messages=False,
+            supports_inline_queries=False,
+        )
+
+    @staticmethod
+    def _user(user_id: int) -> User:
+        return User(user_id, first_name=f"User {user_id}", is_bot=False)
+
+    def _chat(self, chat_id: int) -> Chat:
+        if chat_id > 0:
+            return Chat(chat_id, Chat.PRIVATE, first_name=f"User {chat_id}")
+        return Chat(
+            chat_id, Chat.SUPERGROUP, title=self._titles.get(chat_id, f"Chat {chat_id}")
+        )
+
+    def _message(self, token: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        return Message(
+            params.get("message_id") or next(self._message_ids),
+            datetime.now(tz=timezone.utc),
+            self._chat(_chat_id(params.get("chat_id"))),
+            from_user=self._bot(token),
+            text=params.get("text"),
+        ).to_dict()
+
+    async def _get_updates(self, token: str, params: Dict[str, Any]) -> List[Any]:
+        # Nothing ever happens, but don't let a poller spin
+        await asyncio.sleep(min(float(params.get("timeout", 0)), 5))
+        return []
+
+    def _get_chat(self, token: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat = self._chat(_chat_id(params.get("chat_id")))
+        pinned = self._pins.get(chat.id)
+        return ChatFullInfo(
+            chat.id,
+            chat.type,
+            accent_color_id=0,
+            max_reaction_count=11,
+            accepted_gift_types=AcceptedGiftTypes.de_json(
+                dict.fromkeys(GIFT_TYPES, False), None
+            ),
+            title=chat.title,
+            first_name=chat.first_name,
+            pinned_message=(
+                None
+                if pinned is None
+                else Message(pinned, datetime.now(tz=timezone.utc), chat)
+            ),
+        ).to_dict()
+
+    def _get_chat_administrators(
+        self, token: str, params: Dict[str, Any]
+    ) -> List[Dict[str, Any]]:
+        return [
+            ChatMemberOwner(self._user(self.admin_id), is_anonymous=False).to_dict(),
+            ChatMemberAdministrator(
+                self._bot(token),
+                can_be_edited=False,
+                is_anonymous=False,
+                can_manage_chat=True,
+                can_delete_messages=True,
+                can_manage_video_chats=True,
+                can_restrict_members=True,
+                can_promote_members=False,
+                can_change_info=True,
+                can_invite_users=True,
+                can_post_stories=False,
+                can_edit_stories=False,
+                can_delete_stories=False,
+                can_pin_messages=True,
+            ).to_dict(),
+        ]
+
+    def _get_chat_member(self, token: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        user = self._user(int(params["user_id"]))
+        if user.id == self.admin_id:
+            return ChatMemberOwner(user, is_anonymous=False).to_dict()
+        return ChatMemberLeft(user).to_dict()
+
+    def _set_chat_title(self, token: str, params: Dict[str, Any]) -> bool:
+        self._titles[_chat_id(params["chat_id"])] = str(params["title"])
+        return True
+
+    def _pin_chat_message(self, token: str, params: Dict[str, Any]) -> bool:
+        self._pins[_chat_id(params["chat_id"])] = int(params["message_id"])
+        return True
+
+    def _unpin_chat_message(self, token: str, params: Dict[str, Any]) -> bool:
+        chat_id = _chat_id(params["chat_id"])
+        if "message_id" not in params or self._pins.get(chat_id) == int(
+            params["message_id"]
+        ):
+            self._pins.pop(chat_id, None)
+        return True
+
+    def _copy_message(self, token: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {"message_id": next(self._message_ids)}
+
+    def _export_chat_invite_link(self, token: str, params: Dict[str, Any]) -> str:
+        return "https://t.me/+fakeprimary{}".format(next(self._link_ids))
+
+    def _create_chat_invite_link(
+        self, token: str, params: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        expire_date = params.get("expire_date")
+        link = ChatInviteLink(
+            "https://t.me/+fake{}".format(next(self._link_ids)),
+            self._bot(token),
+            creates_join_request=bool(params.get("creates_join_request")),
+            is_primary=False,
+            is_revoked=False,
+            name=params.get("name"),
+            expire_date=(
+                None
+                if expire_date is None
+                else datetime.fromtimestamp(int(expire_date), tz=timezone.utc)
+            ),
+        )
+        self._links[link.invite_link] = link
+        return link.to_dict()
+
+    def _revoke_chat_invite_link(
+        self, token: str, params: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        link = self._links.pop(params["invite_link"], None)
+        data = (
+            link.to_dict()
+            if link is not None
+            else {
+                "invite_link": params["invite_link"],
+                "creator": self._bot(token).to_dict(),
+                "creates_join_request": False,
+                "is_primary": False,
+            }
+        )
+        data["is_revoked"] = True
+        return data
+
+    def next_show(self) -> int:
+        """The Unix time /nextshow/ says the next show starts."""
+        self.nextshow_hits += 1
+        return int(
+            (
+                datetime.now(tz=timezone.utc) + timedelta(seconds=self.next_show_in)
+            ).timestamp()
+        )
+
+
+class _MethodHandler(tornado.web.RequestHandler):
+    def initialize(self, api: FakeBotAPI):
+        self.api = api
+
+    def _params(self) -> Dict[str, Any]:
+        params = {
+            key: _decode(values[-1].decode("utf-8", "replace"))
+            for key, values in self.request.arguments.items()
+            if values
+        }
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params.update(json.loads(self.request.body or b"{}"))
+        return params
+
+    async def get(self, token: str, method: str) -> None:
+        await self.post(token, method)
+
+    async def post(self, token: str, method: str) -> None:
+        try:
+            result = await self.api.call(token, method, self._params())
+        except ApiError as e:
+            self.set_status(e.code)
+            body = {"ok": False, "error_code": e.code, "description": e.description}
+            if e.retry_after is not None:
+                body["parameters"] = {"retry_after": e.retry_after}
+            self.finish(body)
+            return
+        self.finish({"ok": True, "result": result})
+
+
+class _CallsHandler(tornado.web.RequestHandler):
+    def initialize(self, api: FakeBotAPI):
+        self.api = api
+
+    def get(self) -> None:
+        self.finish(
+            {
+                "total": len(self.api.calls),
+                "refused": self.api.refused,
+                "nextshow": self.api.nextshow_hits,
+                "methods": dict(self.api.counts()),
+            }
+        )
+
+    def delete(self) -> None:
+        self.api.reset()
+        self.set_status(204)
+
+
+class _NextShowHandler(tornado.web.RequestHandler):
+    def initialize(self, api: FakeBotAPI):
+        self.api = api
+
+    async def get(self) -> None:
+        await self.api.delay()
+        self.finish(str(self.api.next_show()))
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """The FakeBotAPI options, for scripts that run one."""
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to every response"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Up to this many more seconds"
+    )
+    parser.add_argument(
+        "--rate-429",
+        type=float,
+        default=0.0,
+        help="Fraction of calls refused with 429 Too Many Requests",
+    )
+    parser.add_argument(
+        "--retry-after", type=int, default=1, help="retry_after sent with 429s"
+    )
+
+
+def from_arguments(args: argparse.Namespace, **kwargs) -> FakeBotAPI:
+    return FakeBotAPI(
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_429=args.rate_429,
+        retry_after=args.retry_after,
+        **kwargs,
+    )
+
+
+def bind(address: str = "127.0.0.1", port: int = 0) -> Tuple[List[socket.socket], int]:
+    """Listening sockets and their port, which is picked if port is 0.
+
+    Binding before the bot is imported lets scripts put the port in its config.
+    """
+    sockets = tornado.netutil.bind_sockets(port, address)
+    return sockets, sockets[0].getsockname()[1]
+
+
+def start(api: FakeBotAPI, sockets: List[socket.socket]) -> HTTPServer:
+    """Serve api on bound sockets. Must be called on the running loop."""
+    server = HTTPServer(api.application())
+    server.add_sockets(sockets)
+    return server
+
+
+async def serve(api: FakeBotAPI, address: str, port: int) -> None:
+    sockets, port = bind(address, port)
+    start(api, sockets)
+    print(f"Fake Bot API on http://{address}:{port}/bot")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument(
+        "--admin-id", type=int, default=1000, help="User who owns every group"
+    )
+    parser.add_argument(
+        "--next-show-in",
+        type=int,
+        default=3600,
+        help="Seconds from now /nextshow/ says the next show starts",
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(
+            serve(
+                from_arguments(
+                    args, admin_id=args.admin_id, next_show_in=args.next_show_in
+                ),
+                args.listen,
+                args.port,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
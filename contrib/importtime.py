@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Measure how long each entry point takes to import, with `python -X importtime`,
+# and check neither pulls in modules it shouldn't need.
+# Run from the repo root with a config, eg.
+#       CONFIG=config.toml.example ./contrib/importtime.py
+# telegram.ext, and apscheduler through it, are the floor for both, as GCF
+# needs ExtBot for its rate limiter. tornado is only kept out of gcf in an
+# environment installed from requirements.txt, as on GCF.
+# Exits non-zero if a forbidden module was imported.
+
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+ENTRY_POINTS: Dict[str, Tuple[str, List[str]]] = {
+    # GCF: only what announcements and Now Playing need
+    "gcf": (
+        "main",
+        [
+            "ddate",
+            "dateutil",
+            "flask",
+            "furcastbot.furcastbot",
+            "furcastbot.nextshow",
+            "furcastbot.server",
+            "furcastbot.stats",
+            "furcastbot.topics",
+            "tornado",
+        ],
+    ),
+    # Poll bot: everything but the web frameworks and rarely used extras
+    "poll": (
+        "furcastbot.furcastbot",
+        ["ddate", "flask", "furcastbot.server"],
+    ),
+}
+
+
+# telegram.ext imports these whenever they're installed, so they're only
+# checked where they aren't
+INSTALLED_ANYWAY = {
+    "tornado": "it's installed (pyproject's webhooks extra), so telegram.ext loads it"
+}
+
+
+def import_times(module: str) -> Dict[str, Tuple[int, int]]:
+    """Self and cumulative import time in µs of every module `module` imports."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+    )
+    if result.returncode != 0:
+        sys.exit(f"Importing {module} failed:\n{result.stderr}")
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Import time of the entry points, and forbidden imports"
+    )
+    parser.add_argument(
+        "entry_points",
+        nargs="*",
+        metavar="ENTRY_POINT",
+        help="Which to measure: {} (default: all)".format(", ".join(ENTRY_POINTS)),
+    )
+    parser.add_argument(
+        "-n", "--runs", type=int, default=5, help="Imports to take the median of"
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Slowest modules to list by self time"
+    )
+    args = parser.parse_args()
+    for entry_point in args.entry_points:
+        if entry_point not in ENTRY_POINTS:
+            parser.error(f"unknown entry point {entry_point!r}")
+
+    failed = False
+    for entry_point in args.entry_points or ENTRY_POINTS:
+        module, forbidden = ENTRY_POINTS[entry_point]
+        for name, why in INSTALLED_ANYWAY.items():
+            if name in forbidden and importlib.util.find_spec(name) is not None:
+                forbidden = [f for f in forbidden if f != name]
+                print(f"{entry_point}: not checking {name}, {why}")
+        runs = [import_times(module) for _ in range(args.runs)]
+        total = statistics.median(run[module][1] for run in runs) / 1000
+        print(
+            f"{entry_point}: import {module} took {total:.1f}ms (median of {len(runs)})"
+        )
+
+        last = runs[-1]
+        for name, (self_us, _) in sorted(
+            last.items(), key=lambda item: item[1][0], reverse=True
+        )[: args.top]:
+            print(f"  {self_us / 1000:8.1f}ms  {name}")
+
+        imported = [
+            name
+            for name in forbidden
+            if any(m == name or m.startswith(name + ".") for m in last)
+        ]
+        if imported:
+            failed = True
+            print(f"  FAIL: imports {', '.join(imported)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+# Load test the announce/Now Playing webhook, as GCF runs it.
+# Sends a mix of Now Playing titles and announcements at a steady rate, and
+# reports latency percentiles, errors and Bot API calls per webhook hit.
+# By default it runs everything itself: contrib/fakebotapi.py as Telegram, and
+# live.webhook behind a threaded WSGI server like the GCF runtime. Run from the
+# repo root like this:
+#       PYTHONPATH=. ./contrib/loadtest.py --rate 20 --duration 30 --latency 0.05
+# Or aim it at a running server, eg. `furcastbot --webhook` or contrib/server.py,
+# with contrib/fakebotapi.py as its Bot API server:
+#       ./contrib/loadtest.py --url http://127.0.0.1:8080/ --apikey KEY \
+#           --fake-api http://127.0.0.1:8081 --group test --show test
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from collections import Counter
+import itertools
+import logging
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from bench_handlers import percentile, use_config
+from fakebotapi import add_arguments, bind, FakeBotAPI, from_arguments, start
+import httpx
+
+DEFAULT_MIX = "title=8,announce=1,pin=1"
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown request kind {kind!r}")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def title_form(i: int, args: argparse.Namespace) -> Dict[str, str]:
+    return {"title": f"Track {i}", "show": args.show}
+
+
+def announce_form(i: int, args: argparse.Namespace) -> Dict[str, str]:
+    return {"group": args.group, "message": f"Announcement {i}", "forward": "true"}
+
+
+def pin_form(i: int, args: argparse.Namespace) -> Dict[str, str]:
+    return {"group": args.group, "message": f"Pinned {i}", "pin": "true"}
+
+
+def unpin_form(i: int, args: argparse.Namespace) -> Dict[str, str]:
+    return {"group": args.group, "pin": "false"}
+
+
+KINDS = {
+    "title": title_form,
+    "announce": announce_form,
+    "pin": pin_form,
+    "unpin": unpin_form,
+}
+
+
+class Hit:
+    """One webhook request and how it went."""
+
+    __slots__ = ("kind", "latency", "outcome", "error")
+
+    def __init__(self, kind: str, latency: float, outcome: str, error: bool):
+        self.kind = kind
+        self.latency = latency
+        self.outcome = outcome
+        self.error = error
+
+
+def serve_webhook() -> Tuple[int, threading.Thread]:
+    """live.webhook on a threaded WSGI server, as the GCF runtime calls it."""
+    from flask import Flask, request
+    from werkzeug.serving import make_server
+
+    from furcastbot.live import webhook
+
+    app = Flask("loadtest")
+
+    @app.route("/", methods=["GET", "POST"])
+    def thing():
+        return webhook(request)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.server_port, thread
+
+
+async def fake_calls(
+    client: httpx.AsyncClient, api: Optional[FakeBotAPI], fake_url: Optional[str]
+) -> Optional[Counter]:
+    """Bot API calls so far, from our own fake or a running one."""
+    if api is not None:
+        return api.counts()
+    if fake_url is None:
+        return None
+    r = await client.get(fake_url.rstrip("/") + "/_calls")
+    return Counter(r.json()["methods"])
+
+
+async def run(
+    args: argparse.Namespace,
+    url: str,
+    api: Optional[FakeBotAPI] = None,
+    sockets=None,
+) -> List[Hit]:
+    if sockets is not None:
+        start(api, sockets)
+    weights = parse_mix(args.mix)
+    kinds = random.choices(
+        list(weights), list(weights.values()), k=int(args.rate * args.duration)
+    )
+    hits: List[Hit] = []
+    counter = itertools.count(1)
+
+    async with httpx.AsyncClient(
+        timeout=args.timeout,
+        limits=httpx.Limits(max_connections=args.connections),
+    ) as client:
+        if api is None and args.fake_api:
+            await client.delete(args.fake_api.rstrip("/") + "/_calls")
+        before = await fake_calls(client, api, args.fake_api)
+
+        async def hit(kind: str) -> None:
+            form = dict(KINDS[kind](next(counter), args), apikey=args.apikey)
+            started = time.perf_counter()
+            try:
+                r = await client.post(url, data=form)
+            except httpx.HTTPError as e:
+                hits.append(
+                    Hit(kind, time.perf_counter() - started, type(e).__name__, True)
+                )
+                return
+            latency = time.perf_counter() - started
+            outcome = str(r.status_code)
+            try:
+                outcome += " " + r.json()["status"]
+            except (ValueError, KeyError, TypeError):
+                pass
+            hits.append(Hit(kind, latency, outcome, r.status_code >= 400))
+
+        # Open loop: requests go out on schedule however slow the server is
+        loop = asyncio.get_running_loop()
+        begin = loop.time()
+        tasks = []
+        for i, kind in enumerate(kinds):
+            delay = begin + i / args.rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(hit(kind)))
+        await asyncio.gather(*tasks)
+        elapsed = loop.time() - begin
+
+        after = await fake_calls(client, api, args.fake_api)
+    report(hits, elapsed, before, after)
+    return hits
+
+
+def report(
+    hits: List[Hit],
+    elapsed: float,
+    before: Optional[Counter],
+    after: Optional[Counter],
+) -> None:
+    print(
+        "{:<10} {:>6} {:>7} {:>8} {:>8} {:>8} {:>8}".format(
+            "kind", "hits", "errors", "p50 ms", "p90 ms", "p99 ms", "max ms"
+        )
+    )
+    by_kind: Dict[str, List[Hit]] = {}
+    for hit in hits:
+        by_kind.setdefault(hit.kind, []).append(hit)
+    for kind, kind_hits in [*sorted(by_kind.items()), ("all", hits)]:
+        latencies = sorted(hit.latency * 1000 for hit in kind_hits)
+        errors = sum(hit.error for hit in kind_hits)
+        print(
+            "{:<10} {:>6} {:>6.1%} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+                kind,
+                len(kind_hits),
+                errors / len(kind_hits),
+                percentile(latencies, 50),
+                percentile(latencies, 90),
+                percentile(latencies, 99),
+                latencies[-1],
+            )
+        )
+    print(f"\n{len(hits) / elapsed:.1f} hits/s over {elapsed:.1f}s")
+    outcomes = Counter(hit.outcome for hit in hits)
+    print("Responses: " + ", ".join(f"{o} ×{n}" for o, n in outcomes.most_common()))
+    if before is not None and after is not None:
+        calls = after - before
+        total = sum(calls.values())
+        print(f"Bot API calls per hit: {total / len(hits):.2f}")
+        for method, count in calls.most_common():
+            print(f"  {method:<24} {count / len(hits):.2f}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Load test the announce/Now Playing webhook"
+    )
+    parser.add_argument("--rate", type=float, default=10, help="Requests per second")
+    parser.add_argument(
+        "--duration", type=float, default=10, help="Seconds to send requests for"
+    )
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help="Weights of request kinds ({}), default {}".format(
+            ", ".join(KINDS), DEFAULT_MIX
+        ),
+    )
+    parser.add_argument(
+        "--connections", type=int, default=100, help="Max connections at once"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="Seconds before a request fails"
+    )
+    parser.add_argument("--url", help="Webhook to test, instead of running our own")
+    parser.add_argument("--apikey", default="bench")
+    parser.add_argument("--group", default="show", help="[announce] group to post to")
+    parser.add_argument("--show", default="show", help="Show for Now Playing titles")
+    parser.add_argument(
+        "--fake-api",
+        help="With --url, the contrib/fakebotapi.py it uses, to count Bot API calls",
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        parse_mix(args.mix)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)  # The fake's 429s
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    if args.url:
+        hits = asyncio.run(run(args, args.url))
+    else:
+        api = from_arguments(args)
+        sockets, port = bind()
+        with tempfile.TemporaryDirectory() as state:
+            use_config(state, port)
+            webhook_port, _ = serve_webhook()
+            hits = asyncio.run(
+                run(args, f"http://127.0.0.1:{webhook_port}/", api, sockets)
+            )
+    return 1 if any(hit.error for hit in hits) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,7 +11,7 @@ from os import environ
 
 from flask import Flask, request
 
-from main import webhook
+from furcastbot.live import webhook_async
 
 environ["X_GOOGLE_FUNCTION_VERSION"] = "0"
 
@@ -20,8 +20,8 @@ app = Flask(__name__)
 
 @app.route("/", methods=["GET", "POST"])
 @app.route("/<path:path>", methods=["GET", "POST"])
-def thing(*args, **kwargs):
-    return webhook(request)
+async def thing(*args, **kwargs):
+    return await webhook_async(request)
 
 
 if __name__ == "__main__":
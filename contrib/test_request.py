@@ -1,15 +1,15 @@
 #!/usr/bin/env python3
 
-# Send a test request to the bot
+# Send a test update to the bot, as Telegram would to `furcastbot --webhook`
 
 from __future__ import annotations
 
 import json
 
-import requests
+import httpx
 
-webhook = "http://127.0.0.1:5000/furcastbot"
-apikey = "testkey"
+webhook = "http://127.0.0.1:8080/telegram"
+secret_token = "anotherrandomlygeneratedstring"
 
 instr = (
     b'{"update_id":1234,\n"message":{"message_id":456,"from":{"id":'
@@ -23,7 +23,11 @@ instr = (
 instruct = json.loads(instr)
 
 if __name__ == "__main__":
-    r = requests.post("{}?apikey={}".format(webhook, apikey), json=instruct)
+    r = httpx.post(
+        webhook,
+        json=instruct,
+        headers={"X-Telegram-Bot-Api-Secret-Token": secret_token},
+    )
 
     print(r)
     print(r.text)
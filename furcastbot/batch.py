@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+async def run_bounded(
+    items: Iterable[T],
+    worker: Callable[[T], Awaitable[R]],
+    limit: int,
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+) -> List[Tuple[T, Optional[R], Optional[Exception]]]:
+    """Run worker over items, at most limit at a time.
+
+    Returns (item, result, exception) for every item, in order, rather than
+    stopping at the first failure. Flood control is left to the bot's
+    OutboundRateLimiter. on_progress(done, failed) is awaited after each item
+    finishes.
+    """
+    items = list(items)
+    results: List[Tuple[T, Optional[R], Optional[Exception]]] = [
+        (item, None, None) for item in items
+    ]
+    semaphore = asyncio.Semaphore(limit)
+    done = 0
+    failed = 0
+
+    async def run_one(index: int, item: T) -> None:
+        nonlocal done, failed
+        async with semaphore:
+            try:
+                results[index] = (item, await worker(item), None)
+            except Exception as e:
+                results[index] = (item, None, e)
+        done += 1
+        if results[index][2] is not None:
+            failed += 1
+        if on_progress is not None:
+            await on_progress(done, failed)
+
+    await asyncio.gather(*(run_one(i, item) for i, item in enumerate(items)))
+    return results
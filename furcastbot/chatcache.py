@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from telegram import Bot, Chat, Update
+from telegram.constants import ChatType
+from telegram.ext import CallbackContext
+
+from .config import Config
+
+config = Config.get_config()
+
+DEFAULT_TTL_SECONDS = 3600
+CACHED_TYPES = (ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL)
+
+
+class ChatInfo:
+    """What we know about a chat without asking Telegram."""
+
+    __slots__ = ("chat_id", "title", "type", "updated")
+
+    def __init__(self, chat_id: int, title: Optional[str], type: str, updated: float):
+        self.chat_id = chat_id
+        self.title = title
+        self.type = type
+        self.updated = updated
+
+
+class ChatCache:
+    """Title and type of the groups and channels the bot is in.
+
+    Kept current from the chats in incoming updates, title change service
+    messages, and the bot's own title changes, so reading them doesn't need a
+    getChat. Entries not refreshed by any of those for chat_cache_ttl_seconds
+    are fetched again, or dropped by sweep_chat_cache if nothing asks.
+    """
+
+    def __init__(self):
+        self._chats: Dict[int, ChatInfo] = {}
+        self._inflight: Dict[int, asyncio.Task] = {}
+
+    @property
+    def _ttl(self) -> float:
+        return config.config.get("chat_cache_ttl_seconds", DEFAULT_TTL_SECONDS)
+
+    async def _fetch(self, bot: Bot, chat_id: int) -> ChatInfo:
+        chat = await bot.get_chat(chat_id)
+        info = ChatInfo(chat.id, chat.title, chat.type, time.monotonic())
+        self._chats[chat_id] = info
+        return info
+
+    async def get(self, bot: Bot, chat_id: int) -> ChatInfo:
+        """Cached info for a chat, fetched if missing or expired."""
+        info = self._chats.get(chat_id)
+        if info is not None and time.monotonic() - info.updated < self._ttl:
+            return info
+        task = self._inflight.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(bot, chat_id))
+            self._inflight[chat_id] = task
+            task.add_done_callback(lambda t: self._inflight.pop(chat_id, None))
+        return await asyncio.shield(task)
+
+    def observe(self, chat: Chat) -> None:
+        """Refresh title and type from a Chat seen in an update.
+
+        Private chats aren't kept, as only group and channel titles are read.
+        """
+        if chat.type not in CACHED_TYPES:
+            return
+        info = self._chats.get(chat.id)
+        if info is None:
+            self._chats[chat.id] = ChatInfo(
+                chat.id, chat.title, chat.type, time.monotonic()
+            )
+        else:
+            info.title = chat.title
+            info.type = chat.type
+            info.updated = time.monotonic()
+
+    def set_title(self, chat_id: int, title: str) -> None:
+        info = self._chats.get(chat_id)
+        if info is not None:
+            info.title = title
+
+    def sweep(self) -> int:
+        """Forget chats not refreshed for chat_cache_ttl_seconds.
+        Returns how many were dropped."""
+        cutoff = time.monotonic() - self._ttl
+        expired = [
+            chat_id for chat_id, info in self._chats.items() if info.updated <= cutoff
+        ]
+        for chat_id in expired:
+            del self._chats[chat_id]
+        return len(expired)
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+
+chat_cache = ChatCache()
+
+
+async def sweep_chat_cache(context: CallbackContext) -> None:
+    """Drop chats not seen for a while from the chat cache
+    Called periodically by JobQueue"""
+
+    dropped = chat_cache.sweep()
+    if dropped:
+        logging.debug(
+            "Dropped %s expired chats from the cache, %s remain",
+            dropped,
+            len(chat_cache),
+        )
+
+
+async def chat_update(update: Update, context: CallbackContext) -> None:
+    """Bot callback for every update, ahead of the others
+    Keeps the chat cache current"""
+
+    if update.effective_chat is None:
+        return
+    chat_cache.observe(update.effective_chat)
+    message = update.message or update.channel_post
+    if message is None:
+        return
+    if message.new_chat_title is not None:
+        chat_cache.set_title(message.chat_id, message.new_chat_title)
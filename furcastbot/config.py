@@ -1,35 +1,223 @@
 from __future__ import annotations
 
+import asyncio
 from datetime import timedelta
+import hashlib
 import logging
 import os
-from typing import Dict, List, Optional
+import pickle
+import time
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
 
-from tomlkit.toml_file import TOMLFile
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
 
+CACHE_VERSION = 1
 
-class Config:
-    _config_file: str
-    """The config file that was loaded."""
 
-    config: dict
-    """The data read from the config file.
+class _Record:
+    """Base for read-only config records. Fields are set once, by _init()."""
 
-    Do not attempt to write this data back to the file!
-    This structure is modified during loading.
-    """
+    __slots__ = ()
+
+    def _init(self, **fields) -> None:
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+
+class _Settings(_Record):
+    """A config table, with common fields as attributes and the rest by key."""
+
+    __slots__ = ("settings",)
+
+    settings: Mapping[str, Any]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.settings.get(key, default)
+
+    def __getitem__(self, key: str) -> Any:
+        return self.settings[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.settings
+
+
+class ChatConfig(_Settings):
+    """A [chats.<slug>] table, with chat references resolved to IDs."""
+
+    __slots__ = (
+        "slug",
+        "id",
+        "admin_chat_id",
+        "topic_approval_chat_id",
+        "topic_approval_required",
+        "next_show_default",
+    )
+
+    slug: str
+    id: int
+    admin_chat_id: Optional[int]
+    topic_approval_chat_id: Optional[int]
+    topic_approval_required: bool
+    next_show_default: Optional[str]
+
+    def __init__(self, slug: str, table: dict, chat_ids: Dict[str, int]):
+        for key in ("admin_chat", "topic_approval_chat"):
+            if key in table and table[key] not in chat_ids:
+                raise ValueError(f"chats.{slug}.{key}: no chat {table[key]!r}")
+        self._init(
+            settings=MappingProxyType(dict(table, slug=slug)),
+            slug=slug,
+            id=table["id"],
+            admin_chat_id=chat_ids.get(table.get("admin_chat")),
+            topic_approval_chat_id=chat_ids.get(table.get("topic_approval_chat")),
+            topic_approval_required=table.get("topic_approval_required", True),
+            next_show_default=table.get("next_show_default"),
+        )
+
+
+class ShowConfig(_Settings):
+    """A [shows.<slug>] table."""
+
+    __slots__ = ("slug", "name", "domain", "aliases", "nextshow_url")
+
+    slug: str
+    name: str
+    domain: str
+    aliases: Tuple[str, ...]
+    nextshow_url: str
 
-    chat_map: Dict[str, dict]
-    """A map of chat IDs to chat object."""
+    def __init__(self, slug: str, table: dict):
+        self._init(
+            settings=MappingProxyType(dict(table, slug=slug)),
+            slug=slug,
+            name=table["name"],
+            domain=table["domain"],
+            aliases=tuple(table.get("aliases", ())),
+            nextshow_url=table.get(
+                "nextshow_url", "https://{}/nextshow/".format(table["domain"])
+            ),
+        )
+
+
+class ConfigSnapshot(_Record):
+    """Everything loaded from one read of the config file.
+
+    Config.load() builds a new one and swaps it in whole, so readers always
+    see a consistent set of tables.
+    """
 
-    managed_chats: Dict[str, List[str]]
-    """A map of admin chat IDs to a list of chat names they manage."""
+    __slots__ = (
+        "config",
+        "chats",
+        "chat_map",
+        "shows",
+        "managed_chats",
+        "timezones",
+        "join_rate_limit_delay",
+        "announce",
+        "np_targets",
+    )
 
+    config: dict
+    chats: Dict[str, ChatConfig]
+    chat_map: Dict[int, ChatConfig]
+    shows: Dict[str, ShowConfig]
+    managed_chats: Dict[int, List[str]]
     timezones: Dict[str, str]
-    """A map of timezone alias to canonical timezone name."""
+    join_rate_limit_delay: Dict[int, timedelta]
+    announce: Dict[str, Tuple[Tuple[str, Union[int, str]], ...]]
+    np_targets: Dict[str, Tuple[int, ...]]
+
+    def __init__(self, data: dict):
+        # Chat slug -> chat, with chat references resolved
+        chat_ids = {slug: chat["id"] for slug, chat in data["chats"].items()}
+        chats = {
+            slug: ChatConfig(slug, table, chat_ids)
+            for slug, table in data["chats"].items()
+        }
+
+        # Show slugs and aliases -> show. Slugs win over aliases.
+        canonical = {
+            slug: ShowConfig(slug, table) for slug, table in data["shows"].items()
+        }
+        shows = {alias: show for show in canonical.values() for alias in show.aliases}
+        shows.update(canonical)
+        for chat in chats.values():
+            if (
+                chat.next_show_default is not None
+                and chat.next_show_default not in shows
+            ):
+                raise ValueError(
+                    f"chats.{chat.slug}.next_show_default: "
+                    f"no show {chat.next_show_default!r}"
+                )
 
-    join_rate_limit_delay: Dict[str, timedelta]
-    """A map of chat IDs to join delays."""
+        # Admin chat ID -> [managed chat names]
+        managed_chats: Dict[int, List[str]] = {}
+        for chat in chats.values():
+            if chat.admin_chat_id is not None:
+                managed_chats.setdefault(chat.admin_chat_id, []).append(chat.slug)
+
+        # Timezone alias -> canonical timezone name
+        timezones = {
+            alias: canonical_name
+            for canonical_name, aliases in data["timezones"].items()
+            for alias in aliases
+        }
+
+        # Announce group -> (entry, target) pairs. Entries are chat slugs, or
+        # anything Telegram takes as a chat ID.
+        announce = {
+            group: tuple((target, chat_ids.get(target, target)) for target in targets)
+            for group, targets in data["announce"].items()
+        }
+        np_targets = {}
+        for group, targets in data["announce"].items():
+            if not group.endswith("-np"):
+                continue
+            for target in targets:
+                if target not in chat_ids:
+                    raise ValueError(f"announce.{group}: no chat {target!r}")
+            np_targets[group[: -len("-np")]] = tuple(chat_ids[t] for t in targets)
+
+        self._init(
+            config=data,
+            chats=chats,
+            chat_map={chat.id: chat for chat in chats.values()},
+            shows=shows,
+            managed_chats=managed_chats,
+            timezones=timezones,
+            join_rate_limit_delay={
+                chat.id: timedelta(minutes=chat.get("rate_limit_delay_minutes", 0))
+                for chat in chats.values()
+            },
+            announce=announce,
+            np_targets=np_targets,
+        )
+
+
+class Config:
+    _config_file: str
+    """The config file that was loaded."""
+
+    snapshot: ConfigSnapshot
+    """The current configuration. Replaced whole on each load."""
+
+    _file_state: Optional[Tuple[int, int]] = None
+    """Modification time and size of the config file as last read."""
+
+    load_report: str = ""
+    """How long the last load took, and whether the snapshot cache was used."""
 
     _instance: Config = None
     """The singleton instance"""
@@ -55,62 +243,172 @@ class Config:
         self._config_file = config_file
         self.load()
 
+    def _file_stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._config_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _cache_path(self) -> Optional[str]:
+        return os.environ.get("CONFIG_CACHE") or None
+
+    def _read_cache(self) -> Optional[dict]:
+        path = self._cache_path()
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except Exception as e:
+            logging.warning("Could not read config cache %r: %s", path, e)
+            return None
+        if (
+            not isinstance(entry, dict)
+            or entry.get("version") != CACHE_VERSION
+            or entry.get("config_file") != os.path.abspath(self._config_file)
+        ):
+            return None
+        return entry
+
+    def _write_cache(
+        self, file_state: Optional[Tuple[int, int]], digest: str, data: dict
+    ) -> None:
+        path = self._cache_path()
+        if path is None:
+            return
+        entry = {
+            "version": CACHE_VERSION,
+            "config_file": os.path.abspath(self._config_file),
+            "file_state": file_state,
+            "digest": digest,
+            "data": data,
+        }
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("Could not write config cache %r: %s", path, e)
+
+    def _read_data(self, file_state: Optional[Tuple[int, int]]) -> Tuple[dict, str]:
+        """The config file's contents, and where they came from.
+
+        With CONFIG_CACHE set, that file holds the last parse. It's used
+        without reading the config file if its mtime and size are unchanged,
+        or after hashing the config file if they have changed but the
+        contents haven't. Otherwise the config file is parsed and the cache
+        rewritten.
+        """
+        cached = self._read_cache()
+        if cached is not None and file_state and cached["file_state"] == file_state:
+            return cached["data"], "cache"
+        with open(self._config_file, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        if cached is not None and cached["digest"] == digest:
+            self._write_cache(file_state, digest, cached["data"])
+            return cached["data"], "cache, after hashing"
+        data = tomllib.loads(raw.decode("utf-8"))
+        self._write_cache(file_state, digest, data)
+        return data, "parsed"
+
+    def _read(self) -> Tuple[ConfigSnapshot, Optional[Tuple[int, int]], str]:
+        """Parse and check the config file. Raises if it's unusable.
+
+        Also returns a report of how long it took.
+        """
+        start = time.perf_counter()
+        file_state = self._file_stat()
+        data, source = self._read_data(file_state)
+        loaded = time.perf_counter()
+        try:
+            snapshot = ConfigSnapshot(data)
+        except KeyError as e:
+            raise ValueError(f"missing setting {e}") from e
+        built = time.perf_counter()
+        report = "{:.2f}ms ({} {:.2f}ms, snapshot {:.2f}ms)".format(
+            (built - start) * 1000,
+            source,
+            (loaded - start) * 1000,
+            (built - loaded) * 1000,
+        )
+        return snapshot, file_state, report
+
     def load(self):
         logging.info("Loading config from %r...", self._config_file)
-        new_config = TOMLFile(self._config_file).read()
-
-        # show slugs and copy show references to alias names
-        for slug, show in new_config["shows"].items():
-            show["slug"] = slug
-            alias_dict = {alias: show for alias in show.get("aliases", [])}
-            alias_dict.update(new_config["shows"])
-            new_config["shows"] = alias_dict
-
-        # chat slugs
-        for slug, chat in new_config["chats"].items():
-            chat["slug"] = slug
-
-        # chat ID -> chat object
-        new_chat_map = {chat["id"]: chat for chat in new_config["chats"].values()}
-
-        # admin chat ID -> [managed chat names]
-        new_managed_chats = {}
-        for name, chat in new_config["chats"].items():
-            if "admin_chat" not in chat:
-                continue
-            admin_chat_id = new_config["chats"][chat["admin_chat"]]["id"]
-            if admin_chat_id not in new_managed_chats:
-                new_managed_chats[admin_chat_id] = []
-            new_managed_chats[admin_chat_id].append(name)
-
-        # timezone alias -> canonical timezone name
-        new_timezones = {}
-        for canonical, aliases in new_config["timezones"].items():
-            new_timezones.update({alias: canonical for alias in aliases})
-
-        new_join_delay = {
-            chat["id"]: timedelta(minutes=chat.get("rate_limit_delay_minutes", 0))
-            for chat in new_config["chats"].values()
-        }
+        self.snapshot, self._file_state, self.load_report = self._read()
+
+    def changed_on_disk(self) -> bool:
+        """Whether the config file has changed since it was last read."""
+        return self._file_stat() != self._file_state
 
-        (
-            self.config,
-            self.chat_map,
-            self.managed_chats,
-            self.timezones,
-            self.join_rate_limit_delay,
-        ) = (
-            new_config,
-            new_chat_map,
-            new_managed_chats,
-            new_timezones,
-            new_join_delay,
+    async def reload(self) -> None:
+        """Re-read the config file and swap in the result.
+
+        Parsing happens off the event loop. If the file can't be read or
+        doesn't make sense, this raises and the running config is unchanged.
+        """
+        logging.info("Reloading config from %r...", self._config_file)
+        try:
+            snapshot, file_state, report = await asyncio.to_thread(self._read)
+        except Exception:
+            # Don't retry the same broken file
+            self._file_state = self._file_stat()
+            raise
+        if snapshot.config.get("telegram_token") != self.config.get("telegram_token"):
+            logging.warning("telegram_token changed, restart to use it")
+        self.snapshot, self._file_state, self.load_report = (
+            snapshot,
+            file_state,
+            report,
         )
 
     @property
-    def chats(self):
-        return self.config["chats"]
+    def config(self) -> dict:
+        """The data read from the config file, as plain dicts and lists.
+
+        Do not attempt to write this data back to the file!
+        """
+        return self.snapshot.config
+
+    @property
+    def chats(self) -> Dict[str, ChatConfig]:
+        """A map of chat slugs to chats."""
+        return self.snapshot.chats
+
+    @property
+    def chat_map(self) -> Dict[int, ChatConfig]:
+        """A map of chat IDs to chats."""
+        return self.snapshot.chat_map
+
+    @property
+    def shows(self) -> Dict[str, ShowConfig]:
+        """A map of show slugs and aliases to shows."""
+        return self.snapshot.shows
+
+    @property
+    def managed_chats(self) -> Dict[int, List[str]]:
+        """A map of admin chat IDs to a list of chat names they manage."""
+        return self.snapshot.managed_chats
+
+    @property
+    def timezones(self) -> Dict[str, str]:
+        """A map of timezone alias to canonical timezone name."""
+        return self.snapshot.timezones
+
+    @property
+    def join_rate_limit_delay(self) -> Dict[int, timedelta]:
+        """A map of chat IDs to join delays."""
+        return self.snapshot.join_rate_limit_delay
+
+    @property
+    def announce(self) -> Dict[str, Tuple[Tuple[str, Union[int, str]], ...]]:
+        """A map of announce groups to (entry, chat ID or @name) pairs."""
+        return self.snapshot.announce
 
     @property
-    def shows(self):
-        return self.config["shows"]
+    def np_targets(self) -> Dict[str, Tuple[int, ...]]:
+        """A map of show slugs to the IDs of their Now Playing chats."""
+        return self.snapshot.np_targets
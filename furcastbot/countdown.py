@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import logging
+from typing import Dict, Optional
+
+from telegram import Bot
+from telegram.constants import ParseMode
+import telegram.error
+from telegram.ext import Application, CallbackContext, JobQueue
+
+from . import metrics
+from .config import Config, ShowConfig
+from .outbound import Priority
+from .showtime import showtimes
+from .state import get_db
+from .upstream import UpstreamError
+
+config = Config.get_config()
+
+JOB_NAME = "next_pin_scheduler"
+DEFAULT_CATCHUP_INTERVAL = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS next_pins (
+    chat_id INTEGER PRIMARY KEY,
+    message_id INTEGER NOT NULL,
+    slug TEXT NOT NULL,
+    showtime REAL NOT NULL,
+    text TEXT
+);
+"""
+
+
+class PinRecord:
+    """State of one /next pin countdown message."""
+
+    __slots__ = ("chat_id", "message_id", "slug", "showtime", "text")
+
+    def __init__(
+        self,
+        chat_id: int,
+        slug: str,
+        showtime: datetime,
+        message_id: Optional[int] = None,
+        text: Optional[str] = None,
+    ):
+        self.chat_id = chat_id
+        self.slug = slug
+        self.showtime = showtime
+        self.message_id = message_id
+        self.text = text  # Last text sent to Telegram
+
+
+pins: Dict[int, PinRecord] = {}
+"""Active countdowns by chat ID. A new /next pin replaces the old one."""
+
+
+def _save(record: PinRecord) -> None:
+    db = get_db(SCHEMA)
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO next_pins VALUES (?, ?, ?, ?, ?)",
+            (
+                record.chat_id,
+                record.message_id,
+                record.slug,
+                record.showtime.timestamp(),
+                record.text,
+            ),
+        )
+
+
+def _forget(chat_id: int) -> None:
+    db = get_db(SCHEMA)
+    with db:
+        db.execute("DELETE FROM next_pins WHERE chat_id = ?", (chat_id,))
+
+
+def _plural(count: int, unit: str) -> str:
+    return f"{count} {unit}" if count == 1 else f"{count} {unit}s"
+
+
+def render(show: ShowConfig, showtime: datetime, now: datetime) -> str:
+    """Countdown text, only as precise as it needs to be.
+
+    Days away it counts hours, in the last day five-minute steps, and in the
+    last hour minutes, so the text (and so the Bot API edits) changes hourly
+    at first and every minute only at the end.
+    """
+    link = "<a href='https://{}/'>{}</a>".format(show.domain, show.name)
+    delta = showtime - now
+    if delta.total_seconds() < 0:
+        return f"{link} is starting!"
+
+    hours = delta.seconds // (60 * 60)
+    minutes = (delta.seconds // 60) % 60
+    if delta.days > 0:
+        remaining = "{}, {}".format(_plural(delta.days, "day"), _plural(hours, "hour"))
+    elif hours > 0:
+        remaining = "{}, {}".format(
+            _plural(hours, "hour"), _plural(minutes - minutes % 5, "minute")
+        )
+    else:
+        remaining = _plural(minutes, "minute")
+    return f"{link} starts in {remaining}"
+
+
+async def _update(bot: Bot, record: PinRecord, now: datetime) -> None:
+    """Bring one countdown message up to date, if its text has changed."""
+
+    show = config.shows.get(record.slug)
+    if show is None:  # Removed from the config by a reload
+        logging.warning(
+            "Dropping next-pin in %s for unknown show %s", record.chat_id, record.slug
+        )
+        remove_pin(record)
+        return
+    # Follow reschedules, but once the show we're counting down to has
+    # started, don't skip ahead to the one after it.
+    if record.showtime > now:
+        try:
+            record.showtime = await showtimes.get(show)
+        except (UpstreamError, ValueError) as e:
+            logging.debug("Next-pin showtime refresh failed: %s", e)
+
+    text = render(show, record.showtime, now)
+    started = record.showtime <= now
+    if text == record.text:
+        return
+
+    try:
+        if record.message_id is None:
+            message = await bot.send_message(
+                record.chat_id,
+                text,
+                parse_mode=ParseMode.HTML,
+                disable_web_page_preview=True,
+                rate_limit_args=Priority.STATUS,
+            )
+            record.message_id = message.message_id
+            _save(record)
+            try:
+                await bot.pin_chat_message(
+                    record.chat_id,
+                    record.message_id,
+                    disable_notification=True,
+                    rate_limit_args=Priority.STATUS,
+                )
+            except telegram.error.BadRequest as e:
+                # Usually "Not enough rights to pin a message"
+                logging.warning("Next-show pin failed in %s: %s", record.chat_id, e)
+        else:
+            try:
+                await bot.edit_message_text(
+                    text,
+                    record.chat_id,
+                    record.message_id,
+                    parse_mode=ParseMode.HTML,
+                    disable_web_page_preview=True,
+                    rate_limit_args=Priority.STATUS,
+                )
+            except telegram.error.BadRequest as e:
+                if e.message == "Message to edit not found":
+                    logging.debug("Next-show pinned message deleted, removing job")
+                    remove_pin(record)
+                    return
+                elif "exactly the same" not in e.message:
+                    raise e
+        record.text = text
+        if not started:
+            _save(record)
+    except (
+        telegram.error.BadRequest,
+        telegram.error.Forbidden,
+        telegram.error.ChatMigrated,
+    ) as e:
+        # Won't work next time either, eg. no rights, or the bot was removed
+        logging.error("Next-show job failed: %s: %s", record.chat_id, e)
+        remove_pin(record)
+        return
+    except Exception as e:
+        # Eg. network errors and timeouts, so try again on the next tick
+        logging.warning("Next-show update failed in %s: %s", record.chat_id, e)
+        return
+
+    if started:
+        remove_pin(record)
+        try:
+            await bot.unpin_chat_message(
+                record.chat_id, record.message_id, rate_limit_args=Priority.STATUS
+            )
+        except telegram.error.BadRequest as e:
+            # Not pinned any more, or not allowed to unpin
+            logging.debug("Next-show unpin failed in %s: %s", record.chat_id, e)
+
+
+def remove_pin(record: PinRecord) -> None:
+    if pins.get(record.chat_id) is record:
+        del pins[record.chat_id]
+        _forget(record.chat_id)
+
+
+async def tick(context: CallbackContext) -> None:
+    """Update every active countdown
+    Called by JobQueue at the start of each minute while any are active
+    """
+
+    now = datetime.now(tz=timezone.utc)
+    metrics.job_lag_seconds.observe(
+        (now - now.replace(second=0, microsecond=0)).total_seconds(), "next_pin"
+    )
+    logging.debug("Running next-pin scheduler for %s chats", len(pins))
+    await asyncio.gather(
+        *(_update(context.bot, record, now) for record in list(pins.values()))
+    )
+    if not pins:
+        logging.debug("No next-pin countdowns left, stopping scheduler")
+        context.job.schedule_removal()
+
+
+def _ensure_scheduler(job_queue: JobQueue) -> None:
+    if job_queue.get_jobs_by_name(JOB_NAME):
+        return
+    now = datetime.now(tz=timezone.utc)
+    next_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    job_queue.run_repeating(tick, 60, next_minute, name=JOB_NAME)
+
+
+async def add_pin(context: CallbackContext, record: PinRecord) -> None:
+    """Post a new countdown and make sure the scheduler is running."""
+
+    if record.chat_id in pins:
+        logging.info("Replacing next-pin countdown in %s", record.chat_id)
+    pins[record.chat_id] = record
+    await _update(context.bot, record, datetime.now(tz=timezone.utc))
+    if record.chat_id in pins:
+        _ensure_scheduler(context.job_queue)
+
+
+async def _catch_up(context: CallbackContext) -> None:
+    """Bring restored countdowns up to date one at a time, then hand over to
+    the regular scheduler."""
+
+    interval = config.config.get(
+        "pin_catchup_interval_seconds", DEFAULT_CATCHUP_INTERVAL
+    )
+    for record in list(pins.values()):
+        await _update(context.bot, record, datetime.now(tz=timezone.utc))
+        await asyncio.sleep(interval)
+    if pins:
+        _ensure_scheduler(context.job_queue)
+
+
+async def restore_pins(application: Application) -> None:
+    """Reload countdowns saved before the last shutdown
+    Used as an Application post_init hook
+    """
+
+    rows = get_db(SCHEMA).execute("SELECT * FROM next_pins").fetchall()
+    for chat_id, message_id, slug, showtime, text in rows:
+        if slug not in config.shows:
+            logging.warning(
+                "Dropping next-pin in %s for unknown show %s", chat_id, slug
+            )
+            _forget(chat_id)
+            continue
+        pins[chat_id] = PinRecord(
+            chat_id,
+            slug,
+            datetime.fromtimestamp(showtime, tz=timezone.utc),
+            message_id,
+            text,
+        )
+    if pins:
+        logging.info("Restored %s next-pin countdowns", len(pins))
+        application.job_queue.run_once(_catch_up, 0)
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from datetime import datetime
+from datetime import timezone
+import heapq
+import time
+from typing import Dict, Generic, List, Optional, Tuple, TypeVar
+
+from .state import get_db
+
+R = TypeVar("R")
+
+
+class ExpiringIndex(ABC, Generic[R]):
+    """Records with an expiry time, by key and by chat, kept in a state table.
+
+    Each record has a key unique overall, and a chat key unique within its
+    chat_id, eg. a topic proposal's ID and its topic. Adding a record
+    replaces any with the same key or chat key. Lookups skip expired records,
+    and sweep() drops them. The table is read on first use, so the state
+    database isn't opened until something needs it.
+
+    Subclasses set SCHEMA, TABLE and KEY_COLUMN, and map records to rows.
+    """
+
+    SCHEMA: str
+    TABLE: str
+    KEY_COLUMN: str
+
+    def __init__(self):
+        self._by_key: Dict[str, R] = {}
+        self._by_chat: Dict[int, Dict[str, R]] = {}
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._loaded = False
+
+    @abstractmethod
+    def _key(self, record: R) -> str:
+        """The record's unique key"""
+
+    @abstractmethod
+    def _chat_key(self, record: R) -> str:
+        """The record's key within its chat"""
+
+    @abstractmethod
+    def _from_row(self, row: tuple) -> R:
+        """A record from a table row"""
+
+    @abstractmethod
+    def _to_row(self, record: R) -> tuple:
+        """A table row, in column order, for a record"""
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        db = get_db(self.SCHEMA)
+        with db:
+            db.execute(f"DELETE FROM {self.TABLE} WHERE expires <= ?", (time.time(),))
+        for row in db.execute(f"SELECT * FROM {self.TABLE}"):
+            self._index(self._from_row(row))
+
+    def _index(self, record: R) -> None:
+        key = self._key(record)
+        self._by_key[key] = record
+        self._by_chat.setdefault(record.chat_id, {})[self._chat_key(record)] = record
+        heapq.heappush(self._expiry_heap, (record.expires, key))
+
+    def _unindex(self, key: str) -> Optional[R]:
+        record = self._by_key.pop(key, None)
+        if record is None:
+            return None
+        chat_records = self._by_chat[record.chat_id]
+        del chat_records[self._chat_key(record)]
+        if not chat_records:
+            del self._by_chat[record.chat_id]
+        return record
+
+    def _put(self, record: R) -> None:
+        self._load()
+        replaced = self._by_chat.get(record.chat_id, {}).get(self._chat_key(record))
+        if replaced is not None:
+            self._drop(self._key(replaced))
+        self._unindex(self._key(record))
+        self._index(record)
+        row = self._to_row(record)
+        db = get_db(self.SCHEMA)
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO {} VALUES ({})".format(
+                    self.TABLE, ", ".join("?" * len(row))
+                ),
+                row,
+            )
+
+    def _drop(self, key: str) -> Optional[R]:
+        """Forget a record, returning it if we knew about it."""
+        self._load()
+        record = self._unindex(key)
+        if record is not None:
+            db = get_db(self.SCHEMA)
+            with db:
+                db.execute(
+                    f"DELETE FROM {self.TABLE} WHERE {self.KEY_COLUMN} = ?", (key,)
+                )
+        return record
+
+    def get(self, key: str) -> Optional[R]:
+        """An unexpired record by key."""
+        self._load()
+        record = self._by_key.get(key)
+        if record is None or record.expires <= time.time():
+            return None
+        return record
+
+    def find(self, chat_id: int, chat_key: str) -> Optional[R]:
+        """An unexpired record by chat and chat key."""
+        self._load()
+        record = self._by_chat.get(chat_id, {}).get(chat_key)
+        if record is None or record.expires <= time.time():
+            return None
+        return record
+
+    def in_chat(self, chat_id: int) -> List[R]:
+        """Unexpired records for a chat, oldest first."""
+        self._load()
+        now = time.time()
+        return sorted(
+            (r for r in self._by_chat.get(chat_id, {}).values() if r.expires > now),
+            key=lambda r: r.expires,
+        )
+
+    def __len__(self) -> int:
+        self._load()
+        return len(self._by_key)
+
+    def sweep(self, now: Optional[datetime] = None) -> int:
+        """Forget records that have expired. Returns how many were dropped."""
+        self._load()
+        cutoff = (now or datetime.now(tz=timezone.utc)).timestamp()
+        expired = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= cutoff:
+            expires, key = heapq.heappop(self._expiry_heap)
+            # Skip heap entries left behind by removed or replaced records
+            record = self._by_key.get(key)
+            if record is not None and record.expires == expires:
+                self._unindex(key)
+                expired += 1
+        if expired:
+            db = get_db(self.SCHEMA)
+            with db:
+                db.execute(f"DELETE FROM {self.TABLE} WHERE expires <= ?", (cutoff,))
+        if len(self._expiry_heap) > 2 * len(self._by_key) + 64:
+            self._expiry_heap = [(r.expires, k) for k, r in self._by_key.items()]
+            heapq.heapify(self._expiry_heap)
+        return expired
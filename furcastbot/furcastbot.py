@@ -2,52 +2,97 @@
 
 from __future__ import annotations
 
+import argparse
+import asyncio
 import logging
 
+from telegram import Update
 from telegram.constants import MessageEntityType
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
     ChatJoinRequestHandler,
+    ChatMemberHandler,
     CommandHandler,
     filters,
     MessageHandler,
+    TypeHandler,
 )
 
+from .chatcache import chat_update, sweep_chat_cache
 from .config import Config
-from .live import webhook  # noqa: F401
-from .membership import chat_join_request, join_handler, revoke_invite_links
+from .countdown import restore_pins
+from .invites import sweep_invite_links
+from .logconfig import setup_logging
+from .membership import (
+    chat_join_request,
+    drain_join_queue,
+    join_handler,
+    QUEUE_CHECK_INTERVAL,
+    revoke_invite_links,
+)
 from .nextshow import nextshow
+from .outbound import DEFAULT_BASE_URL, OutboundRateLimiter
+from .permissions import chat_member_update
+from .proposals import sweep_topic_proposals
+from .reload import reload_command, setup_reload
 from .report import report, report_mention_wrapper
+from .stats import instrument_handlers, stats_command
+from .timezones import get_resolver
 from .topics import button, topic
+from .upstream import close as close_upstream
 from .utility import chatinfo, start, version
 
 config = Config.get_config()
 
-log_level = getattr(logging, config.config.get("log_level", "INFO"))
-logging.basicConfig(level=log_level)
-logging.getLogger("telegram").setLevel(max(logging.INFO, log_level))
-logging.getLogger("apscheduler").setLevel(max(logging.INFO, log_level))
 
-application = Application.builder().token(config.config["telegram_token"]).build()
+async def post_init(application: Application) -> None:
+    await restore_pins(application)
+    setup_reload(application)
+    if config.config.get("metrics_port"):
+        from .server import DEFAULT_METRICS_LISTEN, serve_metrics
 
+        serve_metrics(
+            config.config["metrics_port"],
+            config.config.get("metrics_listen", DEFAULT_METRICS_LISTEN),
+        )
 
-def main():
-    logging.info("Running standalone")
 
+def build_application() -> Application:
+    """The standalone bot, with its jobs and handlers registered."""
+    application = (
+        Application.builder()
+        .token(config.config["telegram_token"])
+        .base_url(config.config.get("telegram_base_url", DEFAULT_BASE_URL))
+        .rate_limiter(OutboundRateLimiter())
+        .concurrent_updates(config.config.get("concurrent_updates", 1))
+        .post_init(post_init)
+        .post_shutdown(close_upstream)
+        .build()
+    )
+    application.job_queue.run_repeating(sweep_invite_links, 60)
+    application.job_queue.run_repeating(sweep_topic_proposals, 300)
+    application.job_queue.run_repeating(sweep_chat_cache, 600)
+    application.job_queue.run_repeating(drain_join_queue, QUEUE_CHECK_INTERVAL)
+
+    # Ahead of everything else, and doesn't stop other handlers
+    application.add_handler(TypeHandler(Update, chat_update), group=-1)
     application.add_handlers(
         [
             CommandHandler("start", start, ~filters.UpdateType.EDITED),
             CommandHandler("chatinfo", chatinfo, ~filters.UpdateType.EDITED),
             CommandHandler("newlink", revoke_invite_links, ~filters.UpdateType.EDITED),
+            CommandHandler("reload", reload_command, ~filters.UpdateType.EDITED),
             CommandHandler("next", nextshow, ~filters.UpdateType.EDITED),
             CommandHandler("report", report, ~filters.UpdateType.EDITED),
             CommandHandler("admin", report, ~filters.UpdateType.EDITED),
             CommandHandler("admins", report, ~filters.UpdateType.EDITED),
             ChatJoinRequestHandler(chat_join_request),
+            ChatMemberHandler(chat_member_update, ChatMemberHandler.ANY_CHAT_MEMBER),
             CommandHandler("topic", topic, ~filters.UpdateType.EDITED),
             CommandHandler("stopic", topic, ~filters.UpdateType.EDITED),
             CommandHandler("version", version, ~filters.UpdateType.EDITED),
+            CommandHandler("stats", stats_command, ~filters.UpdateType.EDITED),
             MessageHandler(
                 filters.Entity(MessageEntityType.MENTION),
                 report_mention_wrapper,
@@ -56,7 +101,31 @@ def main():
             join_handler,
         ]
     )
-    application.run_polling()
+    instrument_handlers(application)
+    return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FurCast Telegram bot")
+    parser.add_argument(
+        "--webhook",
+        action="store_true",
+        help="Receive updates and live calls over HTTP instead of polling",
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    logging.info("Running standalone")
+    logging.info("Config loaded in %s", config.load_report)
+    get_resolver()  # Build the timezone index now rather than on first /next
+    application = build_application()
+    if args.webhook:
+        from .server import serve  # Only webhook mode needs tornado's server
+
+        asyncio.run(serve(application))
+    else:
+        # chat_member updates are only sent if asked for
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+from datetime import datetime
+import logging
+from typing import List
+
+from telegram.ext import CallbackContext
+
+from .expiring import ExpiringIndex
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invite_links (
+    link TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS invite_links_chat_id ON invite_links (chat_id);
+"""
+
+
+class InviteLink:
+    """An invite link the bot issued."""
+
+    __slots__ = ("link", "chat_id", "expires")
+
+    def __init__(self, link: str, chat_id: int, expires: float):
+        self.link = link
+        self.chat_id = chat_id
+        self.expires = expires
+
+
+class InviteLinkStore(ExpiringIndex[InviteLink]):
+    """Per-user invite links the bot has issued and not yet revoked.
+
+    Revoking a link needs both the link and its chat ID, and the Bot API can't
+    list the links we've made, so we keep them here, indexed both ways and
+    backed by the state database so /newlink still works after a restart.
+    """
+
+    SCHEMA = SCHEMA
+    TABLE = "invite_links"
+    KEY_COLUMN = "link"
+
+    def _key(self, record: InviteLink) -> str:
+        return record.link
+
+    def _chat_key(self, record: InviteLink) -> str:
+        return record.link
+
+    def _from_row(self, row: tuple) -> InviteLink:
+        return InviteLink(*row)
+
+    def _to_row(self, record: InviteLink) -> tuple:
+        return (record.link, record.chat_id, record.expires)
+
+    def add(self, link: str, chat_id: int, expires: datetime) -> None:
+        self._put(InviteLink(link, chat_id, expires.timestamp()))
+
+    def remove(self, link: str) -> bool:
+        """Forget a link. Returns whether we knew about it."""
+        return self._drop(link) is not None
+
+    def links_for_chat(self, chat_id: int) -> List[str]:
+        """Unexpired links for a chat."""
+        return [record.link for record in self.in_chat(chat_id)]
+
+
+invite_links = InviteLinkStore()
+
+
+async def sweep_invite_links(context: CallbackContext) -> None:
+    """Drop expired invite links
+    Called periodically by JobQueue"""
+
+    dropped = invite_links.sweep()
+    if dropped:
+        logging.debug(
+            "Dropped %s expired invite links, %s remain", dropped, len(invite_links)
+        )
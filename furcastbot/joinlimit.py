@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .config import Config
+from .state import get_db
+
+config = Config.get_config()
+
+DEFAULT_QUEUE_MAX = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS join_buckets (
+    chat_id INTEGER PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS join_queue (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    user_reference TEXT NOT NULL,
+    first_name TEXT NOT NULL,
+    UNIQUE (chat_id, user_id)
+);
+"""
+
+
+class QueuedJoin:
+    """Someone waiting for an invite to a rate limited chat."""
+
+    __slots__ = ("seq", "chat_id", "user_id", "user_reference", "first_name")
+
+    def __init__(
+        self,
+        seq: int,
+        chat_id: int,
+        user_id: int,
+        user_reference: str,
+        first_name: str,
+    ):
+        self.seq = seq
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.user_reference = user_reference
+        self.first_name = first_name
+
+
+class JoinLimiter:
+    """Per-chat token bucket for invites, with a FIFO queue for the overflow.
+
+    Each chat with rate_limit_delay_minutes set holds up to rate_limit_burst
+    invites, and regains one every rate_limit_delay_minutes. People who
+    arrive when it's empty wait in line, up to rate_limit_queue_max of them.
+    Bucket levels and queues live in the state database.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[int, Tuple[float, float]] = {}
+        self._queues: Dict[int, List[QueuedJoin]] = {}
+        self._loaded = False
+
+    def _load(self) -> None:
+        self._loaded = True
+        db = get_db(SCHEMA)
+        for chat_id, tokens, updated in db.execute("SELECT * FROM join_buckets"):
+            self._buckets[chat_id] = (tokens, updated)
+        for row in db.execute("SELECT * FROM join_queue ORDER BY seq"):
+            entry = QueuedJoin(*row)
+            self._queues.setdefault(entry.chat_id, []).append(entry)
+
+    @staticmethod
+    def is_limited(chat_id: int) -> bool:
+        delay = config.join_rate_limit_delay.get(chat_id)
+        return delay is not None and delay.total_seconds() > 0
+
+    def _tokens(self, chat_id: int, now: float) -> float:
+        burst = config.chat_map[chat_id].get("rate_limit_burst", 1)
+        delay = config.join_rate_limit_delay[chat_id].total_seconds()
+        tokens, updated = self._buckets.get(chat_id, (burst, now))
+        return min(burst, tokens + (now - updated) / delay)
+
+    def try_acquire(self, chat_id: int) -> bool:
+        """Take an invite slot for a chat, if one is free."""
+        if not self.is_limited(chat_id):
+            return True
+        if not self._loaded:
+            self._load()
+        now = time.time()
+        tokens = self._tokens(chat_id, now)
+        if tokens < 1:
+            return False
+        self._set_tokens(chat_id, tokens - 1, now)
+        return True
+
+    def refund(self, chat_id: int) -> None:
+        """Give back a slot taken for an invite that couldn't be delivered."""
+        if not self.is_limited(chat_id):
+            return
+        now = time.time()
+        self._set_tokens(chat_id, self._tokens(chat_id, now) + 1, now)
+
+    def _set_tokens(self, chat_id: int, tokens: float, now: float) -> None:
+        self._buckets[chat_id] = (tokens, now)
+        db = get_db(SCHEMA)
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO join_buckets VALUES (?, ?, ?)",
+                (chat_id, tokens, now),
+            )
+
+    def queue_length(self, chat_id: int) -> int:
+        if not self._loaded:
+            self._load()
+        return len(self._queues.get(chat_id, ()))
+
+    def position(self, chat_id: int, user_id: int) -> Optional[int]:
+        """1-based place in line, or None if not queued."""
+        if not self._loaded:
+            self._load()
+        for index, entry in enumerate(self._queues.get(chat_id, ())):
+            if entry.user_id == user_id:
+                return index + 1
+        return None
+
+    def enqueue(
+        self, chat_id: int, user_id: int, user_reference: str, first_name: str
+    ) -> Optional[int]:
+        """Add someone to the back of the line.
+
+        Returns their place in line, or None if the line is full.
+        """
+        if not self._loaded:
+            self._load()
+        position = self.position(chat_id, user_id)
+        if position is not None:
+            return position
+        queue = self._queues.setdefault(chat_id, [])
+        queue_max = config.chat_map[chat_id].get(
+            "rate_limit_queue_max", DEFAULT_QUEUE_MAX
+        )
+        if len(queue) >= queue_max:
+            return None
+        db = get_db(SCHEMA)
+        with db:
+            cursor = db.execute(
+                "INSERT INTO join_queue (chat_id, user_id, user_reference, first_name)"
+                " VALUES (?, ?, ?, ?)",
+                (chat_id, user_id, user_reference, first_name),
+            )
+        queue.append(
+            QueuedJoin(cursor.lastrowid, chat_id, user_id, user_reference, first_name)
+        )
+        return len(queue)
+
+    def pop_ready(self) -> List[QueuedJoin]:
+        """Take everyone at the front of a line whose chat has a free slot."""
+        if not self._loaded:
+            self._load()
+        ready = []
+        for chat_id, queue in self._queues.items():
+            if chat_id not in config.chat_map:
+                continue
+            while queue and self.try_acquire(chat_id):
+                ready.append(queue.pop(0))
+        if ready:
+            db = get_db(SCHEMA)
+            with db:
+                db.executemany(
+                    "DELETE FROM join_queue WHERE seq = ?",
+                    [(entry.seq,) for entry in ready],
+                )
+        return ready
+
+
+join_limiter = JoinLimiter()
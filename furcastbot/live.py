@@ -2,61 +2,170 @@ from __future__ import annotations
 
 import asyncio
 import logging
-from typing import TYPE_CHECKING
+import threading
+import time
+from typing import Any, Coroutine, Dict, Mapping, Optional, Tuple, TYPE_CHECKING, Union
 
-from flask import make_response, Response
-from telegram import Bot
+from telegram import Bot, Message
 from telegram.constants import ParseMode
 import telegram.error
+from telegram.ext import ExtBot
 
+from . import metrics
+from .batch import run_bounded
 from .config import Config
+from .nowplaying import NowPlayingCoalescer, np_pins
+from .outbound import DEFAULT_BASE_URL, OutboundRateLimiter, Priority
 
 if TYPE_CHECKING:
     from flask import Request
 
 config = Config.get_config()
 
+DEFAULT_ANNOUNCE_CONCURRENCY = 8
 
-def webhook(request: Request):
-    return asyncio.run(webhook_real(request))
+Reply = Tuple[Union[Dict[str, Any], str], int]
+"""A response body and HTTP status, as Flask views may return them"""
 
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_bot_ready: Optional[asyncio.Task] = None
 
-# Have GCF call this directly once it supports flask async
-async def webhook_real(request: Request):
-    bot = Bot(token=config.config["telegram_token"])
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """The webhook's event loop, started in a background thread on first use.
+
+    The bot and its connection pool are bound to this loop, and it outlives
+    each request, so warm GCF instances reuse both instead of paying for a new
+    loop, HTTP client and TLS handshake on every call.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="webhook-loop", daemon=True
+            ).start()
+        return _loop
+
+
+async def _start_bot() -> ExtBot:
+    global _bot_ready
+    logging.info("Cold start, config loaded in %s", config.load_report)
+    bot = ExtBot(
+        token=config.config["telegram_token"],
+        base_url=config.config.get("telegram_base_url", DEFAULT_BASE_URL),
+        rate_limiter=OutboundRateLimiter(),
+    )
+    try:
+        await bot.initialize()
+    except Exception:
+        _bot_ready = None  # Try again on the next request
+        raise
+    return bot
+
+
+async def get_bot() -> ExtBot:
+    """The shared, initialized webhook bot. Must run on the webhook loop."""
+    global _bot_ready
+    if _bot_ready is None:
+        _bot_ready = asyncio.ensure_future(_start_bot())
+    return await asyncio.shield(_bot_ready)
+
+
+def _submit(coro: Coroutine[Any, Any, Reply]) -> asyncio.Future:
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+def _read_request(request: Request) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Copy what we need out of the Flask request.
+
+    The request proxy only works on the thread handling it, not on the
+    webhook loop.
+    """
     logging.info("access_route: %s", ",".join(request.access_route))
     logging.info("args: %s", request.args)
     logging.info("data: %s", request.data)
     logging.info("form: %s", request.form)
+    return request.args.to_dict(), request.form.to_dict()
+
+
+def webhook(request: Request) -> Reply:
+    """GCF entry point"""
+    return _submit(handle_request(*_read_request(request))).result()
+
+
+async def webhook_async(request: Request) -> Reply:
+    """Entry point for Flask async views"""
+    return await asyncio.wrap_future(_submit(handle_request(*_read_request(request))))
+
+
+async def handle_request(
+    args: Mapping[str, str], form: Mapping[str, str], bot: Optional[Bot] = None
+) -> Reply:
+    """Dispatch a webhook call.
+
+    Uses the shared webhook bot, and must run on the webhook loop, unless
+    given a bot, as `furcastbot --webhook` does.
+    """
+    if "title" in form:
+        path = "title"
+    elif form.get("group", "") in config.announce:
+        path = "announce"
+    else:
+        path = "other"
+    started = time.perf_counter()
+    status = "exception"
+    try:
+        reply = await _dispatch(args, form, bot)
+        status = str(reply[1])
+        return reply
+    finally:
+        metrics.webhook_seconds.observe(time.perf_counter() - started, path)
+        metrics.webhook_responses.inc(path, status)
+
+
+async def _dispatch(
+    args: Mapping[str, str], form: Mapping[str, str], bot: Optional[Bot]
+) -> Reply:
     if "api_key" not in config.config or (
-        request.args.get("apikey") != config.config["api_key"]
-        and request.form.get("apikey") != config.config["api_key"]
+        args.get("apikey") != config.config["api_key"]
+        and form.get("apikey") != config.config["api_key"]
     ):
         logging.error("Incorrect apikey")
-        return make_response("", 404)
-    if "title" in request.form:
-        return await post_np(bot, request.form["title"], request.form.get("show"))
-    if request.form.get("group") in config.config["announce"]:
-        pin = request.form.get("pin")
+        return "", 404
+    if "title" in form:
+        # GCF instances serve one request at a time, so a title held back on
+        # one would be overtaken by the next title, on another instance, and
+        # then overwrite it. Only a long-lived `furcastbot --webhook` merges.
+        return await np_updates.submit(
+            bot or await get_bot(),
+            form["title"],
+            form.get("show", ""),
+            coalesce=bot is not None,
+        )
+    if form.get("group", "") in config.announce:
+        pin = form.get("pin")
         if pin in ["true", "1"]:
             pin = True
         elif pin in ["false", "0"]:
             pin = False
-        notify = True if request.form.get("notify") in ["true", "1"] else False
-        forward = True if request.form.get("forward") in ["true", "1"] else False
+        notify = True if form.get("notify") in ["true", "1"] else False
+        forward = True if form.get("forward") in ["true", "1"] else False
         return await post_pin(
-            bot,
-            request.form["group"],
-            request.form.get("message"),
+            bot or await get_bot(),
+            form["group"],
+            form.get("message"),
             pin,
             notify,
             forward,
         )
+    return {"status": "Error", "error": "Nothing to do"}, 400
 
 
 async def post_pin(
     bot: Bot, group: str, message=None, pin=None, notify=False, forward=False
-) -> Response:
+) -> Reply:
     """Post a message to a group, pin/unpin
     :bot: The telegram Bot object
     :group: The group slug, ie "fc", to match ``announce`` entry
@@ -64,68 +173,116 @@ async def post_pin(
     :pin: None or True/False, whether or not to quiet-pin in first chat
     :notify: True/False, enable notify for channel messages
     :forward: True/False, forward from the first chat to the others
+    Each stage runs in all chats at once, and the response has the outcome
+    of each stage per chat.
     """
 
-    if group not in config.config["announce"]:
-        return make_response({"status": "Error", "message": "Unknown group"}, 400)
+    if group not in config.announce:
+        return {"status": "Error", "message": "Unknown group"}, 400
+
+    announce_list = [target for _, target in config.announce[group]]
+    names = {target: name for name, target in config.announce[group]}
+    limit = config.config.get("announce_concurrency", DEFAULT_ANNOUNCE_CONCURRENCY)
+    results: Dict[str, Dict[str, str]] = {name: {} for name in names.values()}
+    failed = False
 
-    announce_list = config.config["announce"][group]
+    def record(stage: str, outcomes: list) -> None:
+        nonlocal failed
+        for chat_id, _, e in outcomes:
+            if e is None:
+                results[names[chat_id]][stage] = "OK"
+            else:
+                # Usually "Not enough rights to (un)pin a message"
+                logging.warning("%s failed in %s: %s", stage.title(), chat_id, e)
+                results[names[chat_id]][stage] = str(e)
+                failed = True
 
     if message is not None:
-        root_message = await bot.send_message(
-            announce_list[0], message, disable_notification=not notify
-        )
+        try:
+            root_message = await bot.send_message(
+                announce_list[0],
+                message,
+                disable_notification=not notify,
+                rate_limit_args=Priority.BULK,
+            )
+        except telegram.error.TelegramError as e:
+            logging.error("Announcement failed in %s: %s", announce_list[0], e)
+            return {"status": "Error", "message": str(e), "chats": results}, 502
+        results[names[announce_list[0]]]["send"] = "OK"
         sent_messages = {announce_list[0]: root_message}
 
         if forward:
-            for target_chat_id in list(announce_list)[1:]:
-                sent_messages[target_chat_id] = await bot.forward_message(
-                    target_chat_id,
+
+            async def forward_to(chat_id) -> Message:
+                return await bot.forward_message(
+                    chat_id,
                     root_message.chat_id,
                     root_message.message_id,
                     not notify,
+                    rate_limit_args=Priority.BULK,
                 )
 
+            outcomes = await run_bounded(announce_list[1:], forward_to, limit)
+            record("forward", outcomes)
+            sent_messages.update(
+                (chat_id, sent) for chat_id, sent, e in outcomes if e is None
+            )
+
         if notify is True and pin is not False:  # quiet-pin in all chats
-            for chat_id, message in sent_messages.items():
-                # Don't pin in channels / first-groups
-                if chat_id == announce_list[0]:
-                    continue
-                try:
-                    await bot.pin_chat_message(
-                        chat_id, message.message_id, disable_notification=True
-                    )
-                except telegram.error.BadRequest as e:
-                    # Usually "Not enough rights to pin a message"
-                    logging.warning("Pin failed in %s: %s", chat_id, e)
+
+            async def pin_in(chat_id) -> None:
+                await bot.pin_chat_message(
+                    chat_id,
+                    sent_messages[chat_id].message_id,
+                    disable_notification=True,
+                    rate_limit_args=Priority.BULK,
+                )
+
+            # Don't pin in channels / first-groups
+            record(
+                "pin",
+                await run_bounded(
+                    [c for c in sent_messages if c != announce_list[0]], pin_in, limit
+                ),
+            )
 
     if pin is False:
-        for chat_id in announce_list:
-            try:
-                await bot.unpin_chat_message(chat_id)
-            except telegram.error.BadRequest as e:
-                # Usually "Not enough rights to unpin a message"
-                logging.warning("Unpin failed in %s: %s", chat_id, e)
-    return make_response({"status": "OK"}, 200)
+
+        async def unpin_in(chat_id) -> None:
+            await bot.unpin_chat_message(chat_id, rate_limit_args=Priority.BULK)
+
+        record("unpin", await run_bounded(announce_list, unpin_in, limit))
+    return {"status": "Partial" if failed else "OK", "chats": results}, 200
 
 
 async def post_np_group(
     bot: Bot, group_id: int, text: str, oneshot: bool = False
 ) -> None:
-    chat = await bot.get_chat(group_id)
-    pin_id = getattr(chat.pinned_message, "message_id", None)
+    pin_id = np_pins.get(group_id)
+    if pin_id is None:
+        chat = await bot.get_chat(group_id)
+        pin_id = getattr(chat.pinned_message, "message_id", None)
 
     if pin_id is None:
-        pin = await chat.send_message(
-            text, parse_mode=ParseMode.HTML, disable_web_page_preview=True
+        pin = await bot.send_message(
+            group_id,
+            text,
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=True,
+            rate_limit_args=Priority.STATUS,
         )
         try:
             await bot.pin_chat_message(
-                chat.id, pin.message_id, disable_notification=True
+                group_id,
+                pin.message_id,
+                disable_notification=True,
+                rate_limit_args=Priority.STATUS,
             )
         except telegram.error.BadRequest as e:
             # Usually "Not enough rights to pin a message"
-            logging.warning("post_np_group pin failed in %s: %s", chat, e)
+            logging.warning("post_np_group pin failed in %s: %s", group_id, e)
+        else:
+            np_pins.set(group_id, pin.message_id)
     else:
         try:
             await bot.edit_message_text(
@@ -134,45 +291,53 @@ async def post_np_group(
                 pin_id,
                 parse_mode=ParseMode.HTML,
                 disable_web_page_preview=True,
+                rate_limit_args=Priority.STATUS,
             )
         except telegram.error.BadRequest as e:
             if "can't be edited" in e.message:
+                np_pins.forget(group_id)
                 if not oneshot:  # Try once to unpin/post
-                    await bot.unpin_chat_message(chat.id)
-                    return await post_np_group(group_id, text, oneshot=True)
-                return make_response({"status": "Error", "error": "Not my pin"}, 200)
+                    await bot.unpin_chat_message(
+                        group_id, pin_id, rate_limit_args=Priority.STATUS
+                    )
+                    return await post_np_group(bot, group_id, text, oneshot=True)
+                return {"status": "Error", "error": "Not my pin"}, 200
+            if "message to edit not found" in e.message.lower():
+                # Deleted or stale cache entry, look the pin up again
+                np_pins.forget(group_id)
+                if not oneshot:
+                    return await post_np_group(bot, group_id, text, oneshot=True)
+                raise e
             if "exactly the same" not in e.message:
                 raise e
+        np_pins.set(group_id, pin_id)
 
 
-async def post_np(bot: Bot, title: str, show_slug: str) -> None:
+async def post_np(bot: Bot, title: str, show_slug: str) -> Reply:
     """Creates/updates pin for Now Playing
     Called by Gelo
     """
 
     logging.debug("Now playing on %r: %r", show_slug, title)
 
-    if show_slug not in config.config["announce"]:
-        return make_response({"status": "Error", "error": "Unknown show slug"}, 404)
+    if show_slug not in config.announce:
+        return {"status": "Error", "error": "Unknown show slug"}, 404
 
     show = config.shows[show_slug]
 
     text = "Now playing: {title}\n🎵 {show_name} is live!\n"
-    if show != "dd":
+    if show.slug != "dd":
         text += "📺 <a href='https://{domain}/video/'>Watch</a> "
     text += (
         "🎧 <a href='https://{domain}/audio/'>Listen</a> "
         "💬 <a href='https://{domain}/chat/'>Chat</a> "
     )
-    text = text.format(title=title, show_name=show["name"], domain=show["domain"])
+    text = text.format(title=title, show_name=show.name, domain=show.domain)
 
-    groups = config.config["announce"].get(show_slug + "-np")
+    groups = config.np_targets.get(show_slug)
     if groups is None:
-        return make_response(
-            {"status": "Error", "error": "No now-playing chat for show"}, 200
-        )
-    for group_long_slug in groups:
-        group_id = config.config["chats"][group_long_slug]["id"]
+        return {"status": "Error", "error": "No now-playing chat for show"}, 200
+    for group_id in groups:
         try:
             await post_np_group(bot, group_id, text)
         except Exception as e:
@@ -181,4 +346,7 @@ async def post_np(bot: Bot, title: str, show_slug: str) -> None:
 
         # await context.bot.unpin_chat_message(chat.id)
 
-    return make_response({"status": "OK"}, 200)
+    return {"status": "OK"}, 200
+
+
+np_updates = NowPlayingCoalescer(post_np)
@@ -0,0 +1,18 @@
+from __future__ import annotations
+
+import logging
+
+from .config import Config
+
+config = Config.get_config()
+
+
+def setup_logging() -> None:
+    """Log at the configured log_level, for both the poll bot and GCF."""
+    log_level = getattr(logging, config.config.get("log_level", "INFO"))
+    logging.basicConfig(level=log_level)
+    # basicConfig does nothing if a handler is already set up, eg. by the GCF
+    # runtime or by logging at import time
+    logging.getLogger().setLevel(log_level)
+    logging.getLogger("telegram").setLevel(max(logging.INFO, log_level))
+    logging.getLogger("apscheduler").setLevel(max(logging.INFO, log_level))
@@ -1,21 +1,23 @@
 from __future__ import annotations
 
+import asyncio
 from collections import defaultdict
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
 from html import escape
 import logging
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from telegram import (
+    Bot,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
     Update,
 )
-from telegram.constants import ParseMode
+from telegram.constants import MessageLimit, ParseMode
 import telegram.error
 from telegram.ext import (
     CallbackContext,
@@ -25,21 +27,26 @@ from telegram.ext import (
     MessageHandler,
 )
 
-from .config import Config
+from . import metrics
+from .batch import run_bounded
+from .config import ChatConfig, Config
+from .invites import invite_links
+from .joinlimit import join_limiter
+from .outbound import Priority
 
 config = Config.get_config()
 
-# List of (invite_link, chat_id) because revoking an invite link
-# requires both the URL and the chat ID
-join_link_list: List[Tuple[str, int]] = []
-join_rate_limit_last_join: Dict[str, datetime] = defaultdict(
-    lambda: datetime(1970, 1, 1, 0, 0, 0, 0, tzinfo=timezone.utc)
-)
-
 
 JOIN_START, JOIN_READING_RULES = range(2)
 RULE_ACCEPT_STRING = "I agree"
 RULE_REJECT_STRING = "Never mind"
+DEFAULT_REVOKE_CONCURRENCY = 8
+PROGRESS_INTERVAL = 2  # seconds between /newlink progress edits
+QUEUE_CHECK_INTERVAL = 30  # seconds between invites to people waiting in line
+DEFAULT_QUEUED_TEMPLATE = (
+    "Sorry, lots of people are joining right now. You're number {position} in "
+    "line, and I'll send your invite link here as soon as it's your turn."
+)
 
 
 async def join_start(update: Update, context: CallbackContext) -> int:
@@ -62,9 +69,10 @@ async def join_start(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
 
     context.user_data["join_chat_name"] = chat_name_to_join
+    metrics.joins.inc("started")
 
     await update.effective_chat.send_message(
-        config.chat_map[config.chats[chat_name_to_join]["id"]]
+        config.chats[chat_name_to_join]
         .get("invite_greeting", "Please click the button.")
         .format(escaped_fname=escape(user.first_name), chat=chat_name_to_join),
         parse_mode=ParseMode.HTML,
@@ -77,7 +85,7 @@ async def join_start(update: Update, context: CallbackContext) -> int:
     return JOIN_READING_RULES
 
 
-async def join_real(update: Update, context: CallbackContext) -> int:
+async def join_real(update: Update, context: CallbackContext) -> Optional[int]:
     """Group join rules-accepted handler
     Gives user invite link button"""
 
@@ -87,10 +95,10 @@ async def join_real(update: Update, context: CallbackContext) -> int:
 
     chat_name_to_join = context.user_data["join_chat_name"]
     chat_to_join = config.chats[chat_name_to_join]
-    current_timestamp = datetime.now(tz=timezone.utc)
     user = update.effective_user
+    metrics.joins.inc("accepted_rules")
 
-    user_status = await context.bot.get_chat_member(chat_to_join["id"], user.id)
+    user_status = await context.bot.get_chat_member(chat_to_join.id, user.id)
     # user_status.LEFT is "they are not a member, but can join on their own"
     # This means that people who are banned are also excluded from joining
     # through the bot (with a somewhat confusing error).
@@ -101,9 +109,10 @@ async def join_real(update: Update, context: CallbackContext) -> int:
             user.id,
             user.username,
             user.full_name,
-            chat_to_join["slug"],
+            chat_to_join.slug,
             user_status.status,
         )
+        metrics.joins.inc("already_member")
         await update.message.reply_text(
             (
                 "You're already in the {} group!\n"
@@ -113,33 +122,75 @@ async def join_real(update: Update, context: CallbackContext) -> int:
         )
         return ConversationHandler.END
 
+    user_reference = ("@" + user.username) if user.username else user.full_name
+
     # If join rate limits are enabled, throttle joins to prevent join flooding.
-    if config.chat_map[chat_to_join["id"]].get("rate_limit_delay_minutes", 0) > 0:
-        logging.debug("rate limiting is active for chat %s", chat_to_join["slug"])
-        time_since_last_join = (
-            current_timestamp - join_rate_limit_last_join[chat_to_join["id"]]
-        )
-        logging.debug(
-            "it has been %s since the last permitted join", time_since_last_join
-        )
-        if time_since_last_join < config.join_rate_limit_delay[chat_to_join["id"]]:
+    # Anyone who can't have a link right now waits in line, and gets it from
+    # drain_join_queue when their turn comes.
+    if join_limiter.is_limited(chat_to_join.id):
+        logging.debug("rate limiting is active for chat %s", chat_to_join.slug)
+        if join_limiter.queue_length(
+            chat_to_join.id
+        ) > 0 or not join_limiter.try_acquire(chat_to_join.id):
+            position = join_limiter.enqueue(
+                chat_to_join.id, user.id, user_reference, user.first_name
+            )
+            if position is None:  # Line's full, they'll have to try again
+                logging.info(
+                    "Denying join by %s (%s, %s) to %s, waiting line is full",
+                    user.username,
+                    user.full_name,
+                    user.id,
+                    chat_to_join.slug,
+                )
+                metrics.joins.inc("line_full")
+                await update.message.reply_html(
+                    text=config.config["rate_limit_template"]
+                    .replace("\n", " ")
+                    .replace("<br>", "\n")
+                    .format(escaped_fname=escape(user.first_name)),
+                    disable_web_page_preview=True,
+                )
+                return None  # Don't end, so accepting the rules again retries
+
             logging.info(
-                "Denying join by %s (%s, %s) to %s due to rate limit",
+                "Queueing join by %s (%s, %s) to %s due to rate limit, position %s",
                 user.username,
                 user.full_name,
                 user.id,
-                chat_to_join["slug"],
+                chat_to_join.slug,
+                position,
             )
+            metrics.joins.inc("queued")
+            del context.user_data["join_chat_name"]
             await update.message.reply_html(
-                text=config.config["rate_limit_template"]
+                text=config.config.get(
+                    "rate_limit_queued_template", DEFAULT_QUEUED_TEMPLATE
+                )
                 .replace("\n", " ")
                 .replace("<br>", "\n")
-                .format(escaped_fname=escape(user.first_name)),
+                .format(escaped_fname=escape(user.first_name), position=position),
                 disable_web_page_preview=True,
+                reply_markup=ReplyKeyboardRemove(),
             )
-            return  # Don't end
-    join_rate_limit_last_join[chat_to_join["id"]] = current_timestamp
+            return ConversationHandler.END
+
     del context.user_data["join_chat_name"]
+    await send_invite(
+        context.bot, chat_to_join, user.id, user_reference, user.first_name
+    )
+    return ConversationHandler.END
+
+
+async def send_invite(
+    bot: Bot,
+    chat_to_join: ChatConfig,
+    user_id: int,
+    user_reference: str,
+    first_name: str,
+) -> bool:
+    """Create a single-use invite link and PM it to the user.
+    Returns whether it was delivered."""
 
     # Create and send link. creates_join_request prevents use of member_limit.
     # We use the link name to associate it with one user, and revoke it after
@@ -148,35 +199,36 @@ async def join_real(update: Update, context: CallbackContext) -> int:
     # restarts.
     try:
         # 5 second minimum
-        expiry_date = current_timestamp + timedelta(
+        expiry_date = datetime.now(tz=timezone.utc) + timedelta(
             minutes=config.config.get("join_link_valid_minutes", 10), seconds=5
         )
         logging.info(
-            "Inviting %s (%s, %s) to %s, link expiry %s",
-            user.username,
-            user.full_name,
-            user.id,
-            chat_to_join["slug"],
+            "Inviting %s (%s) to %s, link expiry %s",
+            user_reference,
+            user_id,
+            chat_to_join.slug,
             expiry_date,
         )
 
-        user_reference = ("@" + user.username) if user.username else user.full_name
-        custom_join_link = await context.bot.create_chat_invite_link(
-            chat_to_join["id"],
+        custom_join_link = await bot.create_chat_invite_link(
+            chat_to_join.id,
             expire_date=expiry_date,
-            name=f"{user.id} {user_reference}",
+            name=f"{user_id} {user_reference}",
             creates_join_request=True,
+            rate_limit_args=Priority.URGENT,
         )
-        join_link_list.append((custom_join_link.invite_link, chat_to_join["id"]))
+        invite_links.add(custom_join_link.invite_link, chat_to_join.id, expiry_date)
 
-        await update.message.reply_html(
+        await bot.send_message(
+            user_id,
             text=chat_to_join.get(
                 "invite_confirmation",
                 "Here's your invite link. Use it before it expires!",
             )
             .replace("\n", " ")
             .replace("<br>", "\n")
-            .format(escaped_fname=escape(user.first_name)),
+            .format(escaped_fname=escape(first_name)),
+            parse_mode=ParseMode.HTML,
             reply_markup=InlineKeyboardMarkup(
                 [
                     [
@@ -188,14 +240,55 @@ async def join_real(update: Update, context: CallbackContext) -> int:
                 ]
             ),
             disable_web_page_preview=True,
+            rate_limit_args=Priority.URGENT,
         )
     except telegram.error.TelegramError as e:
         logging.info("Could not generate invite link: %s", e)
-        await update.message.reply_html(
-            text="Uh oh, something went wrong. Poke an admin.",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-    return ConversationHandler.END
+        metrics.joins.inc("invite_failed")
+        try:
+            await bot.send_message(
+                user_id,
+                text="Uh oh, something went wrong. Poke an admin.",
+                reply_markup=ReplyKeyboardRemove(),
+            )
+        except telegram.error.TelegramError:
+            pass  # Probably blocked the bot
+        return False
+    metrics.joins.inc("invited")
+    return True
+
+
+async def drain_join_queue(context: CallbackContext) -> None:
+    """Invite people waiting in line, as join rate limits allow
+    Called periodically by JobQueue"""
+
+    for entry in join_limiter.pop_ready():
+        chat_to_join = config.chat_map[entry.chat_id]
+        try:
+            user_status = await context.bot.get_chat_member(
+                entry.chat_id, entry.user_id
+            )
+        except telegram.error.TelegramError as e:
+            logging.warning("Dropping queued join by %s: %s", entry.user_id, e)
+            join_limiter.refund(entry.chat_id)
+            continue
+        if user_status.status != user_status.LEFT:
+            logging.info(
+                "Dropping queued join by %s to %s, status=%s",
+                entry.user_id,
+                chat_to_join.slug,
+                user_status.status,
+            )
+            join_limiter.refund(entry.chat_id)
+            continue
+        if not await send_invite(
+            context.bot,
+            chat_to_join,
+            entry.user_id,
+            entry.user_reference,
+            entry.first_name,
+        ):
+            join_limiter.refund(entry.chat_id)
 
 
 async def join_cancel(update: Update, context: CallbackContext) -> int:
@@ -235,13 +328,14 @@ join_handler = ConversationHandler(
 )
 
 
-def revoke_invite_links(update: Update, context: CallbackContext) -> None:
+async def revoke_invite_links(update: Update, context: CallbackContext) -> None:
     """Bot /newlink callback
-    Revokes all known invite links for target chat
+    Revokes all known invite links for target chat, or with "all", for every
+    chat managed from this admin chat
     NOTES: Each admin has a DIFFERENT INVITE LINK.
     The bot API does not allow it to fetch a list of links it's created, so
-    it can only revoke ones created since startup or the one fed to it with
-    /newlink CHAT_SLUG INVITE_LINK
+    it can only revoke unexpired ones it has recorded, or the one fed to it
+    with /newlink CHAT_SLUG INVITE_LINK
     """
 
     # if this chat doesn't manage any chats
@@ -249,79 +343,120 @@ def revoke_invite_links(update: Update, context: CallbackContext) -> None:
         return
 
     args = update.message.text.split(" ")
-    target = None
+    targets = []
     managed = config.managed_chats.get(update.effective_chat.id, [])
     if len(args) < 2:
         if len(managed) == 1:
-            target = managed[0]
-    else:
-        if args[1].lower() in managed:
-            target = args[1].lower()
-    if not target:
-        update.message.reply_text(
+            targets = [managed[0]]
+    elif args[1].lower() == "all" and len(args) == 2:
+        targets = list(managed)
+    elif args[1].lower() in managed:
+        targets = [args[1].lower()]
+    if not targets:
+        await update.message.reply_text(
             "Chat slug missing or invalid. You can act on these chats: "
             + ", ".join(managed)
+            + (", or all of them with /newlink all" if len(managed) > 1 else "")
         )
         return
 
-    target_id = config.chats[target]["id"]
     specific_link_str = None
     if len(args) > 2:
+        target_id = config.chats[targets[0]].id
         links = [(link, target_id) for link in args[2:]]
         specific_link_str = ", ".join(args[2:])
     else:
-        links = [x for x in join_link_list if x[1] == target_id]
+        links = [
+            (link, config.chats[target].id)
+            for target in targets
+            for link in invite_links.links_for_chat(config.chats[target].id)
+        ]
 
     logging.info(
         "%s (%s) requested invite link revocation for %s: %s",
         update.effective_user.name,
         update.effective_user.id,
-        target,
+        ", ".join(targets),
         specific_link_str or "(all)",
     )
+    limit = config.config.get("revoke_concurrency", DEFAULT_REVOKE_CONCURRENCY)
 
     reply_text = ""
     # Regenerate the bot's own invite link, just in case.
     if specific_link_str is None:
-        try:
-            bot_join_link = context.bot.export_chat_invite_link(
-                config.chats[target]["id"]
+
+        async def rotate(target: str) -> None:
+            bot_join_link = await context.bot.export_chat_invite_link(
+                config.chats[target].id
             )
             if bot_join_link is None:
                 raise Exception("exportChatInviteLink returned None")
-            logging.info("New bot primary invite link: %s", bot_join_link)
-        except Exception as e:
-            logging.error("Invite link rotation failed: %s", e)
-            reply_text += "Rotation of bot's primary invite link failed: " + str(e)
-        else:
-            reply_text += "Bot's primary invite link rotated."
+            logging.info(
+                "New bot primary invite link for %s: %s", target, bot_join_link
+            )
+
+        for target, _, e in await run_bounded(targets, rotate, limit):
+            prefix = f"{target}: " if len(targets) > 1 else ""
+            if e is not None:
+                logging.error("Invite link rotation failed for %s: %s", target, e)
+                reply_text += (
+                    f"{prefix}Rotation of bot's primary invite link failed: {e}\n"
+                )
+            else:
+                reply_text += f"{prefix}Bot's primary invite link rotated.\n"
 
     # Revoke all of the per-user invite links that the bot has issued.
-    error_links = []
-    removed_count = 0
-    for link_tuple in links:
-        link, chat_id = link_tuple
-        if link_tuple in join_link_list:
-            join_link_list.remove(link_tuple)
+    progress = await update.message.reply_text(
+        reply_text + f"Revoking {len(links)} per-user invite links...",
+        disable_web_page_preview=True,
+    )
+    loop = asyncio.get_running_loop()
+    last_progress = loop.time()
+
+    async def on_progress(done: int, failed: int) -> None:
+        nonlocal last_progress
+        if done == len(links) or loop.time() - last_progress < PROGRESS_INTERVAL:
+            return
+        last_progress = loop.time()
+        try:
+            await progress.edit_text(
+                reply_text
+                + f"Revoking per-user invite links: {done}/{len(links)} done, "
+                f"{failed} failed...",
+                disable_web_page_preview=True,
+            )
+        except telegram.error.TelegramError as e:
+            logging.debug("Revocation progress update failed: %s", e)
 
+    async def revoke(link_tuple: Tuple[str, int]) -> None:
+        link, chat_id = link_tuple
         logging.info(
             "Revoking invite link for %s: %s",
-            config.chat_map[chat_id]["slug"],
+            config.chat_map[chat_id].slug,
             link,
         )
-        try:
-            revoked_link = context.bot.revoke_chat_invite_link(chat_id, link)
-            if not revoked_link.is_revoked:
-                raise Exception("Mysterious failure")
-            removed_count += 1
-        except Exception as e:
+        revoked_link = await context.bot.revoke_chat_invite_link(chat_id, link)
+        if not revoked_link.is_revoked:
+            raise Exception("Mysterious failure")
+        invite_links.remove(link)
+
+    error_links: Dict[int, List[str]] = defaultdict(list)
+    for (link, chat_id), _, e in await run_bounded(links, revoke, limit, on_progress):
+        if e is not None:
             logging.error("Revocation failed for %s with error: %s", link, e)
-            error_links.append(link)
-    reply_text += "\n{} per-user invite links revoked, {} failed.".format(
-        removed_count, len(error_links)
+            error_links[chat_id].append(link)
+    failed_count = sum(len(failed) for failed in error_links.values())
+    reply_text += "{} per-user invite links revoked, {} failed.".format(
+        len(links) - failed_count, failed_count
     )
-    reply_text += "".join(["\nFailed: " + link for link in error_links])
-    update.message.reply_text(reply_text, disable_web_page_preview=True)
+    # One retry command per chat, ready to copy
+    for chat_id, failed in error_links.items():
+        reply_text += "\nFailed: /newlink {} {}".format(
+            config.chat_map[chat_id].slug, " ".join(failed)
+        )
+    if len(reply_text) > MessageLimit.MAX_TEXT_LENGTH:
+        reply_text = reply_text[: MessageLimit.MAX_TEXT_LENGTH - 1] + "…"
+    await progress.edit_text(reply_text, disable_web_page_preview=True)
 
 
 async def chat_join_request(update: Update, context: CallbackContext) -> None:
@@ -345,28 +480,28 @@ async def chat_join_request(update: Update, context: CallbackContext) -> None:
             e,
         )
     else:
-        invite_tuple = (request.invite_link.invite_link, request.chat.id)
-        if invite_tuple in join_link_list:
-            join_link_list.remove(invite_tuple)
+        invite_links.remove(request.invite_link.invite_link)
 
     # Approve or decline request
     request_user_id = int(request.invite_link.name.split(" ", 1)[0])
     if request_user_id != request.from_user.id:
         logging.warning(
             "Declining join request to %s: %s (%s, %s) used a link meant for %s",
-            config.chat_map[request.chat.id]["slug"],
+            config.chat_map[request.chat.id].slug,
             request.from_user.id,
             request.from_user.username,
             request.from_user.full_name,
             request.invite_link.name,
         )
+        metrics.joins.inc("declined")
         await request.decline()
     else:
         logging.info(
             "Approving join request to %s by %s (%s, %s)",
-            config.chat_map[request.chat.id]["slug"],
+            config.chat_map[request.chat.id].slug,
             request.from_user.id,
             request.from_user.username,
             request.from_user.full_name,
         )
+        metrics.joins.inc("approved")
         await request.approve()
@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+import bisect
+import math
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+Labels = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric(ABC):
+    __slots__ = ("name", "help", "labelnames")
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Labels = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+
+    def _labels(self, labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, labels))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in pairs) + "}"
+
+    @abstractmethod
+    def _samples(self) -> Iterator[str]:
+        """Sample lines in the Prometheus text format"""
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._samples()
+
+
+class Counter(_Metric):
+    """A count that only goes up, per set of label values."""
+
+    __slots__ = ("_values",)
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Labels = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def items(self) -> List[Tuple[Labels, float]]:
+        return sorted(self._values.items())
+
+    def _samples(self) -> Iterator[str]:
+        for labels, value in self.items():
+            yield f"{self.name}{self._labels(labels)} {_format_value(value)}"
+
+
+class _Series:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets: int):
+        self.counts = [0] * buckets
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """Observations counted into buckets, per set of label values."""
+
+    __slots__ = ("buckets", "_series")
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Labels = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series: Dict[Labels, _Series] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = _Series(len(self.buckets))
+        series.counts[bisect.bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return 0 if series is None else series.count
+
+    def quantile(self, q: float, *labels: str) -> float:
+        """Upper bound of the bucket holding the q quantile, eg. 0.99."""
+        series = self._series.get(labels)
+        if series is None or series.count == 0:
+            return math.nan
+        rank = q * series.count
+        seen = 0
+        for bound, count in zip(self.buckets, series.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def label_sets(self) -> List[Labels]:
+        return sorted(self._series)
+
+    def _samples(self) -> Iterator[str]:
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.counts):
+                cumulative += count
+                le = self._labels(labels, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{self._labels(labels)} {series.sum!r}"
+            yield f"{self.name}_count{self._labels(labels)} {series.count}"
+
+
+class Registry:
+    """Every metric, for rendering in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self.started = time.time()
+
+    def counter(self, name: str, help: str, labelnames: Labels = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Labels = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = [
+            "# HELP furcastbot_start_time_seconds When the bot started",
+            "# TYPE furcastbot_start_time_seconds gauge",
+            f"furcastbot_start_time_seconds {self.started!r}",
+        ]
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    "furcastbot_handler_seconds", "Time handling an update, by handler", ("handler",)
+)
+handler_errors = registry.counter(
+    "furcastbot_handler_errors_total", "Updates whose handler raised", ("handler",)
+)
+webhook_seconds = registry.histogram(
+    "furcastbot_webhook_seconds",
+    "Time answering announce and Now Playing calls",
+    ("path",),
+)
+webhook_responses = registry.counter(
+    "furcastbot_webhook_responses_total",
+    "Announce and Now Playing calls answered, by HTTP status",
+    ("path", "status"),
+)
+bot_api_seconds = registry.histogram(
+    "furcastbot_bot_api_seconds",
+    "Time for Bot API calls, including rate limit waits and retries",
+    ("method",),
+)
+bot_api_queue_seconds = registry.histogram(
+    "furcastbot_bot_api_queue_seconds",
+    "Time Bot API calls waited for the outbound rate limits",
+    ("priority",),
+)
+bot_api_errors = registry.counter(
+    "furcastbot_bot_api_errors_total", "Bot API calls that failed", ("method",)
+)
+bot_api_retry_after = registry.counter(
+    "furcastbot_bot_api_retry_after_total",
+    "429 Too Many Requests answers from the Bot API",
+    ("method",),
+)
+job_lag_seconds = registry.histogram(
+    "furcastbot_job_lag_seconds",
+    "How late periodic jobs started",
+    ("job",),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+joins = registry.counter(
+    "furcastbot_joins_total", "People reaching each step of /join", ("step",)
+)
+
+JOIN_STEPS = (
+    "started",
+    "accepted_rules",
+    "already_member",
+    "queued",
+    "line_full",
+    "invited",
+    "invite_failed",
+    "approved",
+    "declined",
+)
+"""Steps of joining a chat, in order, for /stats"""
+
+
+def _ms(seconds: float) -> str:
+    if math.isnan(seconds):
+        return "-"
+    if seconds == math.inf:
+        return "inf"
+    return f"{seconds * 1000:.0f}"
+
+
+def stats_text() -> str:
+    """A summary of the metrics, for /stats."""
+    uptime = int(time.time() - registry.started)
+    lines = [
+        "Up {}d {:02}:{:02}".format(
+            uptime // 86400, uptime // 3600 % 24, uptime // 60 % 60
+        ),
+        "",
+        "Handlers: updates errors p50/p99 ms",
+    ]
+    for (name,) in handler_seconds.label_sets():
+        lines.append(
+            "{} {} {} {}/{}".format(
+                name,
+                handler_seconds.count(name),
+                int(handler_errors.value(name)),
+                _ms(handler_seconds.quantile(0.5, name)),
+                _ms(handler_seconds.quantile(0.99, name)),
+            )
+        )
+    lines += ["", "Bot API: calls 429s errors p50/p99 ms"]
+    for (method,) in bot_api_seconds.label_sets():
+        lines.append(
+            "{} {} {} {} {}/{}".format(
+                method,
+                bot_api_seconds.count(method),
+                int(bot_api_retry_after.value(method)),
+                int(bot_api_errors.value(method)),
+                _ms(bot_api_seconds.quantile(0.5, method)),
+                _ms(bot_api_seconds.quantile(0.99, method)),
+            )
+        )
+    if webhook_seconds.label_sets():
+        lines += ["", "Webhook: calls p50/p99 ms"]
+        for (path,) in webhook_seconds.label_sets():
+            lines.append(
+                "{} {} {}/{}".format(
+                    path,
+                    webhook_seconds.count(path),
+                    _ms(webhook_seconds.quantile(0.5, path)),
+                    _ms(webhook_seconds.quantile(0.99, path)),
+                )
+            )
+    lines += [
+        "",
+        "Joins: "
+        + ", ".join(f"{step} {int(joins.value(step))}" for step in JOIN_STEPS),
+    ]
+    if job_lag_seconds.count("next_pin"):
+        lines.append(
+            "Next-pin job lag p50/p99: {}/{} ms".format(
+                _ms(job_lag_seconds.quantile(0.5, "next_pin")),
+                _ms(job_lag_seconds.quantile(0.99, "next_pin")),
+            )
+        )
+    return "\n".join(lines)
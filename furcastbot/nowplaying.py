@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sqlite3
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from telegram import Bot
+
+from .config import Config
+from .state import get_db
+
+config = Config.get_config()
+
+DEFAULT_COALESCE_SECONDS = 15.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS np_pins (
+    chat_id INTEGER PRIMARY KEY,
+    message_id INTEGER NOT NULL
+);
+"""
+
+
+class PinIdCache:
+    """Message ID of the Now Playing pin in each chat.
+
+    Saves a getChat on every track change. Entries are dropped when an edit
+    shows the message is gone or isn't ours, and the next update looks it up
+    again. Backed by the state database so warm and restarted instances skip
+    the lookup too. If that can't be opened, it's only kept in memory.
+    """
+
+    def __init__(self):
+        self._pins: Dict[int, int] = {}
+        self._loaded = False
+        self._persist = True
+
+    def _load(self) -> None:
+        self._loaded = True
+        try:
+            db = get_db(SCHEMA)
+            self._pins.update(db.execute("SELECT chat_id, message_id FROM np_pins"))
+        except sqlite3.Error as e:
+            logging.warning("Keeping Now Playing pins in memory only: %s", e)
+            self._persist = False
+
+    def _write(self, sql: str, params: Tuple[int, ...]) -> None:
+        if not self._persist:
+            return
+        try:
+            db = get_db(SCHEMA)
+            with db:
+                db.execute(sql, params)
+        except sqlite3.Error as e:
+            logging.warning("Could not save Now Playing pin: %s", e)
+
+    def get(self, chat_id: int) -> Optional[int]:
+        if not self._loaded:
+            self._load()
+        return self._pins.get(chat_id)
+
+    def set(self, chat_id: int, message_id: int) -> None:
+        if not self._loaded:
+            self._load()
+        if self._pins.get(chat_id) == message_id:
+            return
+        self._pins[chat_id] = message_id
+        self._write(
+            "INSERT OR REPLACE INTO np_pins VALUES (?, ?)", (chat_id, message_id)
+        )
+
+    def forget(self, chat_id: int) -> None:
+        if not self._loaded:
+            self._load()
+        if self._pins.pop(chat_id, None) is None:
+            return
+        self._write("DELETE FROM np_pins WHERE chat_id = ?", (chat_id,))
+
+
+np_pins = PinIdCache()
+
+
+class _ShowUpdates:
+    __slots__ = ("applied", "pending", "version", "next_at", "lock")
+
+    def __init__(self):
+        self.applied: Optional[str] = None  # Title currently shown
+        self.pending: Optional[str] = None  # Newest title waiting to be shown
+        self.version = 0
+        self.next_at = 0.0  # Loop time the next update may go out
+        self.lock = asyncio.Lock()
+
+
+class NowPlayingCoalescer:
+    """Rate limits Now Playing updates per show.
+
+    The first title goes out straight away. Titles that arrive within
+    np_coalesce_seconds of the last update wait for the window to end, and
+    only the newest of them is applied; the requests for the others return
+    "Superseded". The newest request waits for its own update, so there's
+    always a trailing update even where the process is frozen between
+    requests. Repeats of the current or pending title are dropped.
+
+    Only titles reaching the same process are merged, so callers that can't
+    promise that pass coalesce=False. Titles then go out in order of arrival,
+    one at a time, and still never overwrite a newer one.
+    """
+
+    def __init__(
+        self,
+        apply: Callable[[Bot, str, str], Awaitable[Tuple[Any, int]]],
+    ):
+        self._apply = apply
+        self._shows: Dict[str, _ShowUpdates] = {}
+
+    async def submit(
+        self, bot: Bot, title: str, show_slug: str, coalesce: bool = True
+    ) -> Tuple[Any, int]:
+        show = self._shows.get(show_slug)
+        if show is None:
+            show = self._shows[show_slug] = _ShowUpdates()
+        current = show.applied if show.pending is None else show.pending
+        if title == current:
+            return {"status": "OK", "result": "Unchanged"}, 200
+
+        show.pending = title
+        show.version += 1
+        version = show.version
+        loop = asyncio.get_running_loop()
+        delay = show.next_at - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        async with show.lock:
+            if show.version != version:
+                return {"status": "OK", "result": "Superseded"}, 200
+            show.pending = None
+            if title == show.applied:
+                return {"status": "OK", "result": "Unchanged"}, 200
+            if coalesce:
+                show.next_at = loop.time() + config.config.get(
+                    "np_coalesce_seconds", DEFAULT_COALESCE_SECONDS
+                )
+            reply = await self._apply(bot, title, show_slug)
+            if isinstance(reply[0], dict) and reply[0].get("status") == "OK":
+                show.applied = title
+            return reply
@@ -0,0 +1,287 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import timedelta
+from enum import IntEnum
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+import telegram.error
+from telegram.ext import BaseRateLimiter
+
+from . import metrics
+from .config import Config
+
+config = Config.get_config()
+
+DEFAULT_BASE_URL = "https://api.telegram.org/bot"
+# Bot API methods that count towards Telegram's per-chat message limits
+_CHAT_LIMITED_PREFIXES = ("send", "edit", "forward", "copy")
+_CHAT_LIMITED_METHODS = frozenset(
+    ["pinChatMessage", "unpinChatMessage", "setChatTitle"]
+)
+
+
+class Priority(IntEnum):
+    """Order in which queued Bot API requests are let through. Lower first.
+
+    Pass as rate_limit_args to any bot method; anything untagged is
+    INTERACTIVE. Numbered from 1, as PTB drops falsy rate_limit_args.
+    """
+
+    URGENT = 1
+    """Join invites, admin reports"""
+    INTERACTIVE = 2
+    """Replies to commands"""
+    STATUS = 3
+    """Countdown and Now Playing edits"""
+    BULK = 4
+    """Announcements"""
+
+
+def retry_after_seconds(e: telegram.error.RetryAfter) -> float:
+    """RetryAfter.retry_after is an int or a timedelta depending on PTB settings."""
+    retry_after: Union[int, float, timedelta] = e.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class _Bucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a request may go, 0 if it may go now."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = self.blocked_until - now
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return max(wait, 0.0)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        return self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "chat_key", "future")
+
+    def __init__(self, priority: int, seq: int, chat_key, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_key = chat_key
+        self.future = future
+
+    def __lt__(self, other: _Waiter) -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundRateLimiter(BaseRateLimiter[int]):
+    """Throttles every Bot API request the bot makes.
+
+    All requests share one token bucket sized to Telegram's overall limit of
+    about 30 messages per second. Message sends and edits also need a token
+    from their chat's bucket: 20 per minute for groups and channels, about
+    one per second for private chats. Requests waiting for a token are let
+    through in Priority order, and a busy chat doesn't hold up the others. A
+    RetryAfter pauses the request's chat (or everything, for requests without a
+    chat_id) for as long as Telegram asks, and the request is retried.
+
+    Settings come from the [outbound] config table.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._overall: Optional[_Bucket] = None
+        self._chats: Dict[Any, _Bucket] = {}
+        self._waiting: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._pump: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _setting(name: str, default: float) -> float:
+        return config.config.get("outbound", {}).get(name, default)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = None
+        for waiter in self._waiting:
+            waiter.future.cancel()
+        self._waiting = []
+
+    def _bind(self) -> asyncio.AbstractEventLoop:
+        """Set up state on the running loop, or a new one if it has changed."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._overall = _Bucket(
+                self._setting("overall_per_second", 30),
+                self._setting("overall_burst", 30),
+                loop.time(),
+            )
+            self._chats = {}
+            self._waiting = []
+            self._wake = asyncio.Event()
+            self._pump = None
+        return loop
+
+    def _chat_bucket(self, chat_key, now: float) -> _Bucket:
+        bucket = self._chats.get(chat_key)
+        if bucket is None:
+            if len(self._chats) > 1000:
+                self._chats = {
+                    key: b for key, b in self._chats.items() if not b.idle(now)
+                }
+            if isinstance(chat_key, str) or chat_key < 0:
+                bucket = _Bucket(
+                    self._setting("group_per_minute", 20) / 60,
+                    self._setting("group_burst", 5),
+                    now,
+                )
+            else:
+                bucket = _Bucket(
+                    self._setting("private_per_second", 1),
+                    self._setting("private_burst", 3),
+                    now,
+                )
+            self._chats[chat_key] = bucket
+        return bucket
+
+    @staticmethod
+    def _chat_key(endpoint: str, data: Dict[str, Any]):
+        if not (
+            endpoint.startswith(_CHAT_LIMITED_PREFIXES)
+            or endpoint in _CHAT_LIMITED_METHODS
+        ):
+            return None
+        return data.get("chat_id")
+
+    async def _acquire(self, chat_key, priority: int) -> None:
+        loop = self._bind()
+        waiter = _Waiter(priority, next(self._seq), chat_key, loop.create_future())
+        heapq.heappush(self._waiting, waiter)
+        self._wake.set()
+        if self._pump is None or self._pump.done():
+            self._pump = loop.create_task(self._run_pump())
+        await waiter.future
+
+    async def _run_pump(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._waiting:
+            self._wake.clear()
+            now = loop.time()
+            wait = self._overall.wait_time(now)
+            if wait == 0:
+                skipped = []
+                chosen = None
+                while self._waiting:
+                    waiter = heapq.heappop(self._waiting)
+                    if waiter.future.done():  # Cancelled while waiting
+                        continue
+                    if waiter.chat_key is None:
+                        chosen = waiter
+                        break
+                    chat_wait = self._chat_bucket(waiter.chat_key, now).wait_time(now)
+                    if chat_wait == 0:
+                        chosen = waiter
+                        break
+                    skipped.append(waiter)
+                    wait = chat_wait if wait == 0 else min(wait, chat_wait)
+                for waiter in skipped:
+                    heapq.heappush(self._waiting, waiter)
+                if chosen is not None:
+                    self._overall.take()
+                    if chosen.chat_key is not None:
+                        self._chats[chosen.chat_key].take()
+                    chosen.future.set_result(None)
+                    continue
+                if not self._waiting:
+                    break
+            # Sleep until a token frees up, or a new request might be able to go
+            try:
+                await asyncio.wait_for(self._wake.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _pause(self, chat_key, seconds: float) -> None:
+        now = self._loop.time()
+        bucket = self._overall if chat_key is None else self._chat_bucket(chat_key, now)
+        bucket.blocked_until = max(bucket.blocked_until, now + seconds)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict, List[Dict]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict, List[Dict]]:
+        started = time.perf_counter()
+        try:
+            return await self._send(
+                callback, args, kwargs, endpoint, data, rate_limit_args
+            )
+        except Exception:
+            metrics.bot_api_errors.inc(endpoint)
+            raise
+        finally:
+            metrics.bot_api_seconds.observe(time.perf_counter() - started, endpoint)
+
+    async def _send(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict, List[Dict]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict, List[Dict]]:
+        priority = Priority.INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_key = self._chat_key(endpoint, data)
+        retries_left = int(self._setting("max_retries", 3))
+        while True:
+            queued = time.perf_counter()
+            await self._acquire(chat_key, priority)
+            metrics.bot_api_queue_seconds.observe(
+                time.perf_counter() - queued, Priority(priority).name.lower()
+            )
+            try:
+                return await callback(*args, **kwargs)
+            except telegram.error.RetryAfter as e:
+                metrics.bot_api_retry_after.inc(endpoint)
+                seconds = retry_after_seconds(e)
+                # Only pause everything for requests with no chat to blame,
+                # so a flood wait in one chat doesn't hold up join invites
+                if chat_key is None:
+                    chat_key = data.get("chat_id")
+                logging.warning(
+                    "Flood control on %s in %s, pausing for %ss, %s retries left",
+                    endpoint,
+                    chat_key,
+                    seconds,
+                    retries_left,
+                )
+                # The retry, keyed by this chat now, waits out the pause too
+                self._pause(chat_key, seconds)
+                if retries_left == 0:
+                    raise
+                retries_left -= 1
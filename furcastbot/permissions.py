@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from telegram import (
+    Bot,
+    ChatMember,
+    ChatMemberAdministrator,
+    ChatMemberOwner,
+    Update,
+)
+from telegram.ext import CallbackContext
+
+from .config import Config
+
+config = Config.get_config()
+
+DEFAULT_TTL_SECONDS = 600
+
+
+class _ChatAdmins:
+    __slots__ = ("admins", "fetched")
+
+    def __init__(self, admins: Dict[int, ChatMember], fetched: float):
+        self.admins = admins
+        self.fetched = fetched
+
+
+class PermissionCache:
+    """Admins of each chat and their rights, for permission checks.
+
+    Filled from getChatAdministrators the first time a chat is checked, then
+    kept current from chat_member updates, so checks don't cost a Bot API
+    call. Entries are refetched after permission_cache_ttl_seconds in case
+    an update was missed. Concurrent checks in one chat share a single fetch.
+    """
+
+    def __init__(self):
+        self._chats: Dict[int, _ChatAdmins] = {}
+        self._inflight: Dict[int, asyncio.Task] = {}
+
+    @property
+    def _ttl(self) -> float:
+        return config.config.get("permission_cache_ttl_seconds", DEFAULT_TTL_SECONDS)
+
+    async def _fetch(self, bot: Bot, chat_id: int) -> _ChatAdmins:
+        members = await bot.get_chat_administrators(chat_id)
+        entry = _ChatAdmins(
+            {member.user.id: member for member in members}, time.monotonic()
+        )
+        self._chats[chat_id] = entry
+        return entry
+
+    async def _admins(self, bot: Bot, chat_id: int) -> Dict[int, ChatMember]:
+        entry = self._chats.get(chat_id)
+        if entry is not None and time.monotonic() - entry.fetched < self._ttl:
+            return entry.admins
+        task = self._inflight.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(bot, chat_id))
+            self._inflight[chat_id] = task
+            task.add_done_callback(lambda t: self._inflight.pop(chat_id, None))
+        return (await asyncio.shield(task)).admins
+
+    async def get_admin(
+        self, bot: Bot, chat_id: int, user_id: int
+    ) -> Optional[ChatMember]:
+        """The user's ChatMemberOwner/ChatMemberAdministrator, or None."""
+        return (await self._admins(bot, chat_id)).get(user_id)
+
+    async def can(self, bot: Bot, chat_id: int, user_id: int, right: str) -> bool:
+        """Whether a user is the chat's owner, or an admin with this right.
+
+        right is a ChatMemberAdministrator attribute, eg. "can_pin_messages".
+        Everyone may do anything in their own private chat.
+        """
+        if chat_id > 0:
+            return True
+        member = await self.get_admin(bot, chat_id, user_id)
+        return isinstance(member, ChatMemberOwner) or (
+            isinstance(member, ChatMemberAdministrator) and getattr(member, right)
+        )
+
+    def update(self, chat_id: int, member: ChatMember) -> None:
+        """Apply someone's new membership, if we're caching that chat."""
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return
+        if isinstance(member, (ChatMemberOwner, ChatMemberAdministrator)):
+            entry.admins[member.user.id] = member
+        else:
+            entry.admins.pop(member.user.id, None)
+
+    def forget(self, chat_id: int) -> None:
+        self._chats.pop(chat_id, None)
+
+
+permissions = PermissionCache()
+
+
+async def chat_member_update(update: Update, context: CallbackContext) -> None:
+    """Bot chat_member/my_chat_member callback
+    Keeps the permission cache current"""
+
+    change = update.chat_member or update.my_chat_member
+    logging.debug(
+        "%s: %s is now %s",
+        update.effective_chat.id,
+        change.new_chat_member.user.id,
+        change.new_chat_member.status,
+    )
+    permissions.update(update.effective_chat.id, change.new_chat_member)
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import logging
+import secrets
+from typing import Optional
+
+from telegram.ext import CallbackContext
+
+from .config import Config
+from .expiring import ExpiringIndex
+
+config = Config.get_config()
+
+DEFAULT_EXPIRY_HOURS = 24
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS topic_proposals (
+    id TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    topic TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS topic_proposals_chat_id ON topic_proposals (chat_id);
+"""
+
+
+class TopicProposal:
+    """A /topic waiting for approval."""
+
+    __slots__ = ("id", "chat_id", "user_id", "message_id", "topic", "expires")
+
+    def __init__(
+        self,
+        id: str,
+        chat_id: int,
+        user_id: int,
+        message_id: int,
+        topic: str,
+        expires: float,
+    ):
+        self.id = id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.message_id = message_id
+        self.topic = topic
+        self.expires = expires
+
+
+class TopicProposalStore(ExpiringIndex[TopicProposal]):
+    """Pending topic proposals, by short random ID and by chat.
+
+    The approval buttons only carry the ID, so proposals can be any length.
+    Each chat has at most one pending proposal per topic. Proposals expire
+    after topic_proposal_expiry_hours, and are kept in the state database so
+    buttons still work after a restart.
+    """
+
+    SCHEMA = SCHEMA
+    TABLE = "topic_proposals"
+    KEY_COLUMN = "id"
+
+    def _key(self, record: TopicProposal) -> str:
+        return record.id
+
+    def _chat_key(self, record: TopicProposal) -> str:
+        return record.topic
+
+    def _from_row(self, row: tuple) -> TopicProposal:
+        return TopicProposal(*row)
+
+    def _to_row(self, record: TopicProposal) -> tuple:
+        return (
+            record.id,
+            record.chat_id,
+            record.user_id,
+            record.message_id,
+            record.topic,
+            record.expires,
+        )
+
+    def add(
+        self, chat_id: int, user_id: int, message_id: int, topic: str
+    ) -> TopicProposal:
+        """A new proposal, replacing any of the same topic in this chat."""
+        proposal_id = secrets.token_urlsafe(6)
+        while self.get(proposal_id) is not None:
+            proposal_id = secrets.token_urlsafe(6)
+        hours = config.config.get("topic_proposal_expiry_hours", DEFAULT_EXPIRY_HOURS)
+        expires = datetime.now(tz=timezone.utc) + timedelta(hours=hours)
+        proposal = TopicProposal(
+            proposal_id, chat_id, user_id, message_id, topic, expires.timestamp()
+        )
+        self._put(proposal)
+        return proposal
+
+    def remove(self, proposal_id: str) -> Optional[TopicProposal]:
+        """Forget a proposal, returning it if we knew about it."""
+        return self._drop(proposal_id)
+
+
+topic_proposals = TopicProposalStore()
+
+
+async def sweep_topic_proposals(context: CallbackContext) -> None:
+    """Drop expired topic proposals
+    Called periodically by JobQueue"""
+
+    dropped = topic_proposals.sweep()
+    if dropped:
+        logging.debug(
+            "Dropped %s expired topic proposals, %s remain",
+            dropped,
+            len(topic_proposals),
+        )
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+from html import escape
+import logging
+import signal
+from typing import Optional
+
+from telegram import Update
+from telegram.ext import Application, CallbackContext
+
+from .config import Config
+
+config = Config.get_config()
+
+DEFAULT_WATCH_INTERVAL = 30
+
+RESTART_SETTINGS = (
+    "telegram_token",
+    "log_level",
+    "state_db",
+    "concurrent_updates",
+    "metrics_port",
+    "metrics_listen",
+    "webhook",
+    "outbound",
+    "upstream",
+)
+"""Settings only read at startup, eg. to build rate limit buckets or clients"""
+
+_lock: Optional[asyncio.Lock] = None
+
+
+async def reload_config(reason: str) -> Optional[str]:
+    """Reload config.toml, one reload at a time.
+
+    Returns the error if the file was rejected, in which case the running
+    config is untouched.
+    """
+    global _lock
+    if _lock is None:
+        _lock = asyncio.Lock()
+    async with _lock:
+        before = {name: config.config.get(name) for name in RESTART_SETTINGS}
+        try:
+            await config.reload()
+        except Exception as e:
+            logging.error(
+                "Config reload (%s) failed, keeping old config: %s", reason, e
+            )
+            return str(e) or type(e).__name__
+    unapplied = [
+        name for name in RESTART_SETTINGS if config.config.get(name) != before[name]
+    ]
+    if unapplied:
+        logging.warning(
+            "Config reload (%s): changes to %s need a restart",
+            reason,
+            ", ".join(unapplied),
+        )
+    logging.info(
+        "Config reloaded (%s) in %s: %s chats, %s shows",
+        reason,
+        config.load_report,
+        len(config.chats),
+        len(config.shows),
+    )
+    return None
+
+
+async def reload_command(update: Update, context: CallbackContext) -> None:
+    """Bot /reload callback
+    Re-reads config.toml, from admin chats only"""
+
+    if update.effective_chat.id not in config.managed_chats:
+        return
+
+    error = await reload_config("/reload by {}".format(update.effective_user.name))
+    if error is None:
+        await update.message.reply_text("Config reloaded.")
+    else:
+        await update.message.reply_html(
+            "Config not reloaded, still using the old one:\n"
+            f"<code>{escape(error)}</code>"
+        )
+
+
+async def watch_config(context: CallbackContext) -> None:
+    """Reload config.toml when it changes
+    Called periodically by JobQueue"""
+
+    if config.changed_on_disk():
+        await reload_config("file changed")
+
+
+def setup_reload(application: Application) -> None:
+    """Reload on SIGHUP, and when the file changes if config_watch_seconds > 0.
+
+    Call from post_init, as the signal handler needs the running loop.
+    """
+    if hasattr(signal, "SIGHUP"):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP,
+            lambda: application.create_task(reload_config("SIGHUP")),
+        )
+    interval = config.config.get("config_watch_seconds", DEFAULT_WATCH_INTERVAL)
+    if interval > 0:
+        application.job_queue.run_repeating(watch_config, interval)
@@ -7,6 +7,7 @@ from telegram.constants import MessageEntityType, ParseMode
 from telegram.ext import CallbackContext
 
 from .config import Config
+from .outbound import Priority
 
 config = Config.get_config()
 
@@ -33,7 +34,8 @@ async def report(update: Update, context: CallbackContext) -> None:
             text="Reporting messages in PMs isn't done yet; for now please PM an admin directly."
         )
     else:
-        if "admin_chat" not in config.chat_map[update.effective_chat.id]:
+        admin_chat = config.chat_map[update.effective_chat.id].admin_chat_id
+        if admin_chat is None:
             await update.message.reply_text(
                 "Sorry, that's not configured for this group."
             )
@@ -47,15 +49,18 @@ async def report(update: Update, context: CallbackContext) -> None:
             summon_link = update.message.link
             reply_link = update.message.reply_to_message.link
             escaped_report_text = escape(update.message.text)
-            admin_chat = config.chats[
-                config.chat_map[update.effective_chat.id]["admin_chat"]
-            ]["id"]
-            await update.message.reply_to_message.forward(admin_chat)
+            await context.bot.forward_message(
+                admin_chat,
+                update.effective_chat.id,
+                update.message.reply_to_message.message_id,
+                rate_limit_args=Priority.URGENT,
+            )
             await context.bot.send_message(
                 admin_chat,
                 f'{mention} has <a href="{summon_link}">summoned</a> admins in reply '
                 f'to <a href="{reply_link}">the above message</a>; they said:\n'
                 f"{escaped_report_text}",
                 parse_mode=ParseMode.HTML,
+                rate_limit_args=Priority.URGENT,
             )
             await update.message.reply_text("Thank you; we’re on it.")
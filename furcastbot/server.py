@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import asyncio
+import hmac
+import logging
+import signal
+from typing import Dict, Optional
+
+from telegram import Update
+from telegram.ext import Application
+import tornado.httpserver
+import tornado.web
+import ujson
+
+from .config import Config
+from .live import handle_request
+from .metrics import registry
+
+config = Config.get_config()
+
+DEFAULT_LISTEN = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_TELEGRAM_PATH = "/telegram"
+DEFAULT_METRICS_LISTEN = "127.0.0.1"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def _arguments(arguments: Dict[str, list]) -> Dict[str, str]:
+    """Tornado argument lists to a plain dict, last value wins like Flask."""
+    return {
+        key: values[-1].decode("utf-8", "replace")
+        for key, values in arguments.items()
+        if values
+    }
+
+
+class TelegramHandler(tornado.web.RequestHandler):
+    """Receives updates pushed by Telegram and queues them for the bot."""
+
+    def initialize(self, bot_app: Application, secret_token: Optional[str]):
+        self.bot_app = bot_app
+        self.secret_token = secret_token
+
+    async def post(self) -> None:
+        if self.secret_token is not None and not hmac.compare_digest(
+            self.request.headers.get(SECRET_HEADER, ""), self.secret_token
+        ):
+            logging.warning(
+                "Update with bad secret token from %s", self.request.remote_ip
+            )
+            raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(ujson.loads(self.request.body), self.bot_app.bot)
+        except Exception as e:
+            logging.error("Bad update from %s: %s", self.request.remote_ip, e)
+            raise tornado.web.HTTPError(400)
+        await self.bot_app.update_queue.put(update)
+        self.set_status(200)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Prometheus scrapes of the bot's metrics."""
+
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(registry.render())
+
+
+def serve_metrics(
+    port: int, address: str = DEFAULT_METRICS_LISTEN
+) -> tornado.httpserver.HTTPServer:
+    """Serve only /metrics, on its own port, from the running event loop."""
+    web = tornado.web.Application([(r"/metrics", MetricsHandler)])
+    server = web.listen(port, address=address)
+    logging.info("Serving metrics on port %s", port)
+    return server
+
+
+class LiveHandler(tornado.web.RequestHandler):
+    """Announce and Now Playing calls, as served by live.webhook on GCF."""
+
+    def initialize(self, bot_app: Application):
+        self.bot_app = bot_app
+
+    async def get(self) -> None:
+        await self.post()
+
+    async def post(self) -> None:
+        body, status = await handle_request(
+            _arguments(self.request.query_arguments),
+            _arguments(self.request.body_arguments),
+            self.bot_app.bot,
+        )
+        self.set_status(status)
+        self.finish(body)
+
+
+async def serve(application: Application) -> None:
+    """Run the bot with Telegram updates and the live endpoints on one server.
+
+    Settings come from the [webhook] config table. Runs until SIGINT/SIGTERM.
+    """
+    settings = config.config["webhook"]
+    telegram_path = settings.get("telegram_path", DEFAULT_TELEGRAM_PATH)
+    metrics_path = settings.get("metrics_path", "")
+    secret_token = settings.get("secret_token")
+    if secret_token is None:
+        logging.warning("No webhook secret_token set, anyone can post updates")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with application:
+        if application.post_init is not None:
+            await application.post_init(application)
+        await application.start()
+
+        routes = [
+            (
+                telegram_path,
+                TelegramHandler,
+                {"bot_app": application, "secret_token": secret_token},
+            ),
+        ]
+        if metrics_path:
+            routes.append((metrics_path, MetricsHandler))
+        routes.append((r"/.*", LiveHandler, {"bot_app": application}))
+        web = tornado.web.Application(routes)
+        server = web.listen(
+            settings.get("port", DEFAULT_PORT),
+            address=settings.get("listen", DEFAULT_LISTEN),
+            xheaders=True,
+        )
+        if "url" in settings:
+            await application.bot.set_webhook(
+                settings["url"].rstrip("/") + telegram_path,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False,
+            )
+        logging.info("Serving webhook on port %s", settings.get("port", DEFAULT_PORT))
+
+        await stop.wait()
+        logging.info("Stopping webhook server")
+        server.stop()
+        await application.stop()
+    if application.post_shutdown is not None:
+        await application.post_shutdown(application)
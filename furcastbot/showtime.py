@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime
+from datetime import timezone
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+import ujson
+
+from .config import Config, ShowConfig
+from .upstream import fetch_text
+
+config = Config.get_config()
+
+DEFAULT_TTL_SECONDS = 300
+
+
+class _Entry:
+    __slots__ = ("showtime", "fetched")
+
+    def __init__(self, showtime: datetime, fetched: float):
+        self.showtime = showtime
+        self.fetched = fetched
+
+
+class ShowtimeCache:
+    """Next-show timestamps per show slug, shared by /next and next-pin jobs.
+
+    Fresh entries are served from memory. Stale entries are served while a
+    refresh runs in the background, unless the cached show has already
+    started. Concurrent lookups for one show share a single upstream fetch.
+    The last known values are kept on disk so a restart, or the show site
+    being down, doesn't leave us with nothing to say.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, _Entry] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._loaded = False
+
+    @property
+    def _path(self) -> Optional[str]:
+        return config.config.get("showtime_cache_file", "showtime_cache.json")
+
+    @property
+    def _ttl(self) -> float:
+        return config.config.get("showtime_cache_ttl_seconds", DEFAULT_TTL_SECONDS)
+
+    def _load(self) -> None:
+        self._loaded = True
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as f:
+                saved = ujson.load(f)
+            for slug, value in saved.items():
+                self._entries[slug] = _Entry(
+                    datetime.fromtimestamp(value["showtime"], tz=timezone.utc),
+                    value["fetched"],
+                )
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Could not read showtime cache %r: %s", self._path, e)
+
+    def _save(self) -> None:
+        """Write the cache to disk.
+
+        It's a few lines of JSON, so this runs on the event loop, where the
+        entries can't change while they're written.
+        """
+        if not self._path:
+            return
+        data = {
+            slug: {"showtime": entry.showtime.timestamp(), "fetched": entry.fetched}
+            for slug, entry in self._entries.items()
+        }
+        tmp_path = self._path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                ujson.dump(data, f)
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logging.warning("Could not write showtime cache %r: %s", self._path, e)
+
+    async def _fetch(self, show: ShowConfig) -> datetime:
+        text = await fetch_text(show.nextshow_url)
+        showtime = datetime.fromtimestamp(int(text), tz=timezone.utc)
+        self._entries[show.slug] = _Entry(showtime, time.time())
+        self._save()
+        return showtime
+
+    def _refresh(self, show: ShowConfig) -> asyncio.Task:
+        """Start a fetch for this show, or join the one already running."""
+        slug = show.slug
+        task = self._inflight.get(slug)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(show))
+            self._inflight[slug] = task
+            task.add_done_callback(lambda t: self._refresh_done(slug, t))
+        return task
+
+    def _refresh_done(self, slug: str, task: asyncio.Task) -> None:
+        self._inflight.pop(slug, None)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(
+                "Next-show refresh failed for %s: %s", slug, task.exception()
+            )
+
+    async def get(self, show: ShowConfig) -> datetime:
+        """Return the next showtime for a show config entry.
+
+        Raises UpstreamError or ValueError only if the fetch fails and we
+        have never known a value for this show.
+        """
+        if not self._loaded:
+            self._load()
+        entry = self._entries.get(show.slug)
+        if entry is not None:
+            if time.time() - entry.fetched < self._ttl:
+                return entry.showtime
+            if entry.showtime > datetime.now(tz=timezone.utc):
+                self._refresh(show)
+                return entry.showtime
+        try:
+            return await asyncio.shield(self._refresh(show))
+        except Exception:
+            if entry is None:
+                raise
+            logging.warning("Serving stale next-show time for %s", show.slug)
+            return entry.showtime
+
+
+showtimes = ShowtimeCache()
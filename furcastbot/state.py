@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+from typing import Optional, Set
+
+from .config import Config
+
+config = Config.get_config()
+
+_db: Optional[sqlite3.Connection] = None
+_schemas: Set[str] = set()
+
+
+def get_db(schema: Optional[str] = None) -> sqlite3.Connection:
+    """Return the shared state database, creating tables from schema as required.
+
+    This holds the small amount of state that needs to survive restarts. Each
+    module passes its own CREATE TABLE IF NOT EXISTS statements. The STATE_DB
+    environment variable overrides the state_db setting, eg. for GCF, where
+    only /tmp is writable. Raises sqlite3.Error if it can't be opened.
+    """
+    global _db
+    if _db is None:
+        path = os.environ.get("STATE_DB") or config.config.get(
+            "state_db", "furcastbot.sqlite3"
+        )
+        logging.info("Opening state database %r", path)
+        db = sqlite3.connect(path, check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.Error:
+            db.close()
+            raise
+        _db = db
+    if schema is not None and schema not in _schemas:
+        with _db:
+            _db.executescript(schema)
+        _schemas.add(schema)
+    return _db
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import functools
+from html import escape
+import time
+from typing import Any, Callable, Coroutine
+
+from telegram import Update
+from telegram.constants import ParseMode
+from telegram.ext import (
+    Application,
+    ApplicationHandlerStop,
+    BaseHandler,
+    CallbackContext,
+    ConversationHandler,
+)
+
+from .config import Config
+from .metrics import handler_errors, handler_seconds, stats_text
+
+config = Config.get_config()
+
+
+def instrument(
+    callback: Callable[[Update, CallbackContext], Coroutine[Any, Any, Any]],
+    name: str,
+) -> Callable[[Update, CallbackContext], Coroutine[Any, Any, Any]]:
+    """Wrap a handler callback to record its latency and errors."""
+
+    @functools.wraps(callback)
+    async def timed(update: Update, context: CallbackContext) -> Any:
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+
+    return timed
+
+
+def _instrument_handler(handler: BaseHandler) -> None:
+    if isinstance(handler, ConversationHandler):
+        for state_handlers in (
+            handler.entry_points,
+            handler.fallbacks,
+            *handler.states.values(),
+        ):
+            for state_handler in state_handlers:
+                _instrument_handler(state_handler)
+        return
+    handler.callback = instrument(handler.callback, handler.callback.__name__)
+
+
+def instrument_handlers(application: Application) -> None:
+    """Record latency and errors of every handler registered so far."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+async def stats_command(update: Update, context: CallbackContext) -> None:
+    """Bot /stats callback
+    Posts handler, Bot API and join counts, from admin chats only"""
+
+    if update.effective_chat.id not in config.managed_chats:
+        return
+
+    await update.message.reply_text(
+        f"<pre>{escape(stats_text())}</pre>", parse_mode=ParseMode.HTML
+    )
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+from datetime import tzinfo
+import difflib
+from functools import lru_cache
+from typing import Dict, List, Optional
+import zoneinfo
+
+from dateutil import tz
+
+from .config import Config
+
+config = Config.get_config()
+
+# Abbreviations people actually type, which have no tzdata file of their own.
+# Config [timezones] aliases take precedence over these.
+ABBREVIATIONS = {
+    "EDT": "America/New_York",
+    "CDT": "America/Chicago",
+    "CST": "America/Chicago",
+    "MDT": "America/Denver",
+    "PDT": "America/Los_Angeles",
+    "PST": "America/Los_Angeles",
+    "AKDT": "America/Anchorage",
+    "AKST": "America/Anchorage",
+    "HST": "Pacific/Honolulu",
+    "BST": "Europe/London",
+    "IST": "Asia/Kolkata",
+    "CEST": "Europe/Berlin",
+    "EEST": "Europe/Helsinki",
+    "JST": "Asia/Tokyo",
+    "KST": "Asia/Seoul",
+    "AEST": "Australia/Sydney",
+    "AEDT": "Australia/Sydney",
+    "ACST": "Australia/Adelaide",
+    "AWST": "Australia/Perth",
+}
+
+
+@lru_cache(maxsize=1)
+def _zone_index() -> Dict[str, str]:
+    """Lowercase lookup key -> canonical IANA name, for every installed zone.
+
+    Also indexes the last component of each name ("chicago"), where that is
+    unambiguous.
+    """
+    names = zoneinfo.available_timezones()
+    index = {name.lower(): name for name in names}
+    cities: Dict[str, List[str]] = {}
+    for name in names:
+        if "/" in name:
+            cities.setdefault(name.rsplit("/", 1)[1].lower(), []).append(name)
+    for city, matches in cities.items():
+        if len(matches) == 1 and city not in index:
+            index[city] = matches[0]
+    return index
+
+
+@lru_cache(maxsize=None)
+def _zone(name: str) -> Optional[tzinfo]:
+    """Memoized tzinfo for a canonical zone name."""
+    return tz.gettz(name)
+
+
+@lru_cache(maxsize=256)
+def _verbatim(name: str) -> Optional[tzinfo]:
+    """Memoized fallback for things tz.gettz can parse, eg. "UTC+5"."""
+    return tz.gettz(name)
+
+
+class TimezoneResolver:
+    """Case-insensitive timezone lookup, built once per set of config aliases."""
+
+    def __init__(self, aliases: Dict[str, str]):
+        self._aliases = aliases
+        index = {abbr.lower(): name for abbr, name in ABBREVIATIONS.items()}
+        index.update(_zone_index())
+        index.update({alias.lower(): name for alias, name in aliases.items()})
+        self._index = index
+
+    def resolve(self, name: str) -> Optional[tzinfo]:
+        """Return the tzinfo for a user-supplied name, or None."""
+        canonical = self._index.get(name.lower())
+        if canonical is not None:
+            return _zone(canonical)
+        return _verbatim(name)
+
+    def suggest(self, name: str, count: int = 3) -> List[str]:
+        """Return canonical names of the zones closest to a failed lookup."""
+        matches = difflib.get_close_matches(name.lower(), self._index, n=count * 2)
+        suggestions: List[str] = []
+        for match in matches:
+            canonical = self._index[match]
+            if canonical not in suggestions:
+                suggestions.append(canonical)
+        return suggestions[:count]
+
+
+_resolver: Optional[TimezoneResolver] = None
+
+
+def get_resolver() -> TimezoneResolver:
+    """Return the resolver for the current config, building it as required."""
+    global _resolver
+    if _resolver is None or _resolver._aliases is not config.timezones:
+        _resolver = TimezoneResolver(config.timezones)
+    return _resolver
@@ -1,24 +1,24 @@
 from __future__ import annotations
 
+import asyncio
+import html
 import logging
+from typing import Dict, List, Optional
 
-from telegram import (
-    Bot,
-    Chat,
-    ChatMemberAdministrator,
-    ChatMemberOwner,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    Update,
-)
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
 import telegram.error
 from telegram.ext import CallbackContext
 
+from .chatcache import chat_cache
 from .config import Config
+from .permissions import permissions
+from .proposals import topic_proposals
 
 config = Config.get_config()
 
+DEFAULT_COALESCE_SECONDS = 10.0
+
 
 async def topic(update: Update, context: CallbackContext) -> None:
     """Bot /topic callback
@@ -45,13 +45,16 @@ async def topic(update: Update, context: CallbackContext) -> None:
 
     # Unrestricted chat, or admin
     chat = config.chat_map[update.effective_chat.id]
-    user = await update.effective_chat.get_member(update.effective_user.id)
     if (
-        chat.get("topic_approval_required", True) is False
-        or isinstance(user, ChatMemberOwner)
+        not chat.topic_approval_required
         # No reason to require full can_change_info for this.
         # Chatops have can_delete_messages, so let's use that.
-        or (isinstance(user, ChatMemberAdministrator) and user.can_delete_messages)
+        or await permissions.can(
+            context.bot,
+            update.effective_chat.id,
+            update.effective_user.id,
+            "can_delete_messages",
+        )
     ):
         logging.info(
             "%s: %s: %s",
@@ -69,56 +72,55 @@ async def topic(update: Update, context: CallbackContext) -> None:
                     update.effective_chat.id,
                     e,
                 )
-        await topic_set(context.bot, update.effective_chat, requested)
-        if "topic_approval_chat" in chat:
+        report = None
+        if chat.topic_approval_chat_id is not None:
             mention = update.message.from_user.mention_html()
             link = update.message.link
-            await context.bot.send_message(
-                config.chats[chat["topic_approval_chat"]]["id"],
-                (
-                    f'<b>{chat["slug"]}</b>: '
-                    f'{mention} <a href="{link}">set</a> topic "{requested}"\n'
-                ),
-                parse_mode=ParseMode.HTML,
-                disable_notification=True,
-            )
+            report = f'{mention} <a href="{link}">set</a> topic "{requested}"'
+        topic_writer.request(context.bot, update.effective_chat.id, requested, report)
         return
 
-    if "topic_approval_chat" in chat:
-        mention = update.message.from_user.mention_html()
-        link = update.message.link
-        callback_data = ",{},{},{},{}".format(
+    if chat.topic_approval_chat_id is not None:
+        if topic_proposals.find(update.effective_chat.id, requested) is not None:
+            await update.message.reply_text(
+                f'Topic "{requested}" is already waiting for approval'
+            )
+            return
+        proposal = topic_proposals.add(
             update.effective_chat.id,
             update.effective_user.id,
             update.message.message_id,
             requested,
         )
-        if len(callback_data) + 2 > 64:
-            await update.message.reply_text("Sorry, that's too long.")
-            return
-        await context.bot.send_message(
-            config.chats[chat["topic_approval_chat"]]["id"],
-            (
-                f'<b>{chat["slug"]}</b>: '
-                f'{mention} <a href="{link}">proposed</a> topic "{requested}"\n'
-                "Admins can accept, admins or op can reject:"
-            ),
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(
-                [
+        mention = update.message.from_user.mention_html()
+        link = update.message.link
+        try:
+            await context.bot.send_message(
+                chat.topic_approval_chat_id,
+                (
+                    f"<b>{chat.slug}</b>: "
+                    f'{mention} <a href="{link}">proposed</a> topic "{requested}"\n'
+                    "Admins can accept, admins or op can reject:"
+                ),
+                parse_mode=ParseMode.HTML,
+                reply_markup=InlineKeyboardMarkup(
                     [
-                        InlineKeyboardButton(
-                            "Accept", callback_data="ta" + callback_data
-                        ),
-                        InlineKeyboardButton(
-                            "Reject", callback_data="tr" + callback_data
-                        ),
+                        [
+                            InlineKeyboardButton(
+                                "Accept", callback_data=f"ta:{proposal.id}"
+                            ),
+                            InlineKeyboardButton(
+                                "Reject", callback_data=f"tr:{proposal.id}"
+                            ),
+                        ]
                     ]
-                ]
-            ),
-            disable_notification=True,
-        )
-        if chat["topic_approval_chat"] != chat["slug"]:
+                ),
+                disable_notification=True,
+            )
+        except telegram.error.TelegramError:
+            topic_proposals.remove(proposal.id)
+            raise
+        if chat.topic_approval_chat_id != chat.id:
             await update.message.reply_text(f'Requested topic "{requested}"')
         return
 
@@ -129,47 +131,52 @@ async def button(update: Update, context: CallbackContext) -> None:
     data = update.callback_query.data
     # Topic accept/reject buttons
     if data.startswith("t"):
-        action, chat_id, user_id, message_id, requested = data.split(",", 4)
-        chat_id = int(chat_id)
-        target_chat = await context.bot.get_chat(chat_id)
-        user_id = int(user_id)
-        message_id = int(message_id)
-
-        # Get user's perms in /topic'd chat
-        user = await target_chat.get_member(update.effective_user.id)
+        # Buttons from before proposals were stored have no ID, and expire here
+        action, _, proposal_id = data.partition(":")
+        proposal = topic_proposals.get(proposal_id)
+        if proposal is None:
+            await update.callback_query.answer(text="That proposal has expired")
+            return
+        chat_id = proposal.chat_id
+        user_id = proposal.user_id
+        message_id = proposal.message_id
+        requested = proposal.topic
 
         # Not authorized
         if not (
             # Topic requester can reject their own
             (update.effective_user.id == user_id and action == "tr")
-            # Chatops in the /topic'd chat can approve (see topic() note)
-            or getattr(user, "can_delete_messages", False)
-            # I have no idea why being the creator doesn't imply that perm
-            or user.status == "creator"
             # Admin group approval: allow anyone
             or (
                 update.effective_chat.id != chat_id
                 and update.effective_chat.id
-                == config.chats[config.chat_map[chat_id]["topic_approval_chat"]]["id"]
+                == config.chat_map[chat_id].topic_approval_chat_id
+            )
+            # Chatops (or the creator) in the /topic'd chat can approve
+            # (see topic() note)
+            or await permissions.can(
+                context.bot, chat_id, update.effective_user.id, "can_delete_messages"
             )
         ):
             await update.callback_query.answer(text="Nice try")
             return
         logging.debug(
-            "%s: %s: %s bytes: %s",
+            "%s: %s: %s %s",
             update.effective_chat.title,
             update.effective_user.username,
-            len(data),
             data,
+            requested,
         )
 
+        # Claim it, in case of a double click
+        if topic_proposals.remove(proposal_id) is None:
+            await update.callback_query.answer(text="Already done")
+            return
+
         # Buttons
         if action == "ta":
-            await topic_set(context.bot, await context.bot.get_chat(chat_id), requested)
-            if (
-                chat_id
-                != config.chats[config.chat_map[chat_id]["topic_approval_chat"]]["id"]
-            ):
+            topic_writer.request(context.bot, chat_id, requested)
+            if chat_id != config.chat_map[chat_id].topic_approval_chat_id:
                 await context.bot.send_message(
                     chat_id, "Accepted!", reply_to_message_id=message_id
                 )
@@ -194,9 +201,11 @@ async def button(update: Update, context: CallbackContext) -> None:
     logging.error("Button didn't understand callback: %s", data)
 
 
-async def topic_set(bot: Bot, chat: Chat, requested_topic: str) -> None:
-    """Enact a topic change"""
+async def topic_set(bot: Bot, chat_id: int, requested_topic: str) -> Optional[str]:
+    """Enact a topic change
+    Returns the error if the title couldn't be set"""
 
+    chat = await chat_cache.get(bot, chat_id)
     logging.info(
         '%s: Setting topic "%s"',
         chat.title,
@@ -208,7 +217,96 @@ async def topic_set(bot: Bot, chat: Chat, requested_topic: str) -> None:
     if len(requested_topic) > 0:
         requested_topic = sep + requested_topic
     title = chat.title.split(sep, 1)[0] + requested_topic
+    if title == chat.title:
+        logging.debug("%s: Title unchanged", chat.title)
+        return None
     try:
-        await bot.set_chat_title(chat.id, title)
+        await bot.set_chat_title(chat_id, title)
     except telegram.error.BadRequest as e:
-        logging.warning("Title change failed in %s: %s", chat.id, e)
+        logging.warning("Title change failed in %s: %s", chat_id, e)
+        return str(e)
+    chat_cache.set_title(chat_id, title)
+    return None
+
+
+class _PendingTopic:
+    __slots__ = ("topic", "reports", "task", "last_write")
+
+    def __init__(self):
+        self.topic = ""
+        self.reports: List[str] = []  # Changes to tell the approval chat about
+        self.task: Optional[asyncio.Task] = None
+        self.last_write = float("-inf")  # Loop time
+
+
+class TopicWriter:
+    """Applies topic changes, at most one title write per chat per window.
+
+    A change is written straight away, unless the chat's title was written
+    less than topic_coalesce_seconds ago. Then it waits for the window to
+    end, and only the last change made in the meantime is written. Each
+    batch is reported to the approval chat in one message.
+    """
+
+    def __init__(self):
+        self._chats: Dict[int, _PendingTopic] = {}
+
+    def request(
+        self, bot: Bot, chat_id: int, topic: str, report: Optional[str] = None
+    ) -> None:
+        """Queue a topic change. report is a line for the approval chat."""
+        pending = self._chats.get(chat_id)
+        if pending is None:
+            pending = self._chats[chat_id] = _PendingTopic()
+        pending.topic = topic
+        if report is not None:
+            pending.reports.append(report)
+        if pending.task is None:
+            loop = asyncio.get_running_loop()
+            window = config.config.get(
+                "topic_coalesce_seconds", DEFAULT_COALESCE_SECONDS
+            )
+            delay = max(0.0, pending.last_write + window - loop.time())
+            pending.task = loop.create_task(self._write(bot, chat_id, pending, delay))
+            pending.task.add_done_callback(self._write_done)
+
+    async def _write(
+        self, bot: Bot, chat_id: int, pending: _PendingTopic, delay: float
+    ) -> None:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Later requests start a new batch
+        pending.task = None
+        topic, reports = pending.topic, pending.reports
+        pending.reports = []
+        pending.last_write = asyncio.get_running_loop().time()
+
+        error = await topic_set(bot, chat_id, topic)
+        chat = config.chat_map[chat_id]
+        if not reports or chat.topic_approval_chat_id is None:
+            return
+        if len(reports) == 1 and error is None:
+            text = f"<b>{chat.slug}</b>: {reports[0]}\n"
+        else:
+            if error is None:
+                text = f'<b>{chat.slug}</b>: topic is now "{topic}"\n'
+            else:
+                text = (
+                    f'<b>{chat.slug}</b>: topic change to "{topic}" failed: '
+                    f"{html.escape(error)}\n"
+                )
+            text += "\n".join(reports)
+        await bot.send_message(
+            chat.topic_approval_chat_id,
+            text,
+            parse_mode=ParseMode.HTML,
+            disable_notification=True,
+        )
+
+    @staticmethod
+    def _write_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Topic change failed: %s", task.exception())
+
+
+topic_writer = TopicWriter()
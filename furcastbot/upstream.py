@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from .config import Config
+
+config = Config.get_config()
+
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_MAX_CONNECTIONS = 10
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+class UpstreamError(Exception):
+    """An upstream (non-Telegram) HTTP fetch failed."""
+
+
+class _Pool:
+    """A keep-alive client and concurrency limit, bound to one event loop."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        settings = config.config.get("upstream", {})
+        self.loop = loop
+        self.client = httpx.AsyncClient(
+            timeout=settings.get("timeout_seconds", DEFAULT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=settings.get(
+                    "max_connections", DEFAULT_MAX_CONNECTIONS
+                ),
+                max_keepalive_connections=settings.get(
+                    "max_connections", DEFAULT_MAX_CONNECTIONS
+                ),
+            ),
+            headers={"User-Agent": "furcastbot"},
+            follow_redirects=True,
+        )
+        self.semaphore = asyncio.Semaphore(
+            settings.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)
+        )
+
+
+_pool: Optional[_Pool] = None
+
+
+def _get_pool() -> _Pool:
+    """Return the shared pool, creating it for the running loop as required.
+
+    httpx clients can't be shared between event loops, so if we're called from
+    a different loop than the one the pool was made on, start a new one.
+    """
+    global _pool
+    loop = asyncio.get_running_loop()
+    if _pool is None or _pool.loop is not loop or _pool.client.is_closed:
+        _pool = _Pool(loop)
+    return _pool
+
+
+def _timeout_for(url: str) -> float:
+    settings = config.config.get("upstream", {})
+    host = urlsplit(url).hostname or ""
+    return settings.get("host_timeouts", {}).get(
+        host, settings.get("timeout_seconds", DEFAULT_TIMEOUT)
+    )
+
+
+async def fetch_text(url: str) -> str:
+    """GET a URL through the shared pool and return the response body.
+
+    Raises UpstreamError on timeouts, connection failures and non-200s.
+    """
+    pool = _get_pool()
+    async with pool.semaphore:
+        try:
+            r = await pool.client.get(url, timeout=_timeout_for(url))
+        except httpx.TimeoutException as e:
+            raise UpstreamError(f"Timed out fetching {url}") from e
+        except httpx.HTTPError as e:
+            raise UpstreamError(f"Could not fetch {url}: {e}") from e
+    if r.status_code != 200:
+        raise UpstreamError("API returned " + str(r.status_code))
+    return r.text
+
+
+async def close(*args) -> None:
+    """Close the shared pool. Usable as an Application post_shutdown hook."""
+    global _pool
+    if _pool is not None:
+        logging.debug("Closing upstream connection pool")
+        await _pool.client.aclose()
+        _pool = None
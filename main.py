@@ -1 +1,4 @@
-from furcastbot.furcastbot import webhook  # noqa: F401
+from furcastbot.live import webhook  # noqa: F401
+from furcastbot.logconfig import setup_logging
+
+setup_logging()